@@ -0,0 +1,19 @@
+import logging
+
+from background_task import background
+from django.conf import settings
+
+from api.models import IngressKey
+from core.utils import now_stamp
+
+logger_app = logging.getLogger('app')
+
+
+@background
+def evict_ingress_keys():
+    """ Remove the idempotency keys older than INGRESS_KEY_TTL """
+    cutoff = now_stamp() - settings.INGRESS_KEY_TTL * 1000
+    count, _ = IngressKey.objects.filter(timestamp__lt=cutoff).delete()
+    if count:
+        logger_app.info(f"Evicted {count} ingress keys",
+                        extra={'origin': 'INGRESS KEYS'})
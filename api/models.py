@@ -0,0 +1,68 @@
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+
+from core.utils import now_stamp
+
+
+class IngressKey(models.Model):
+    """ The idempotency key of a handled ingress request, a retry with the
+        same key is acknowledged without being handled again
+        Removed after INGRESS_KEY_TTL by evict_ingress_keys
+    """
+    digest = models.CharField(max_length=40, unique=True)
+    timestamp = models.BigIntegerField(db_index=True)
+
+    # The recently handled keys of this process, a retry that comes back to
+    # the same process doesn't need the DB : {digest: expiry}
+    _recent: 'OrderedDict[str, float]' = OrderedDict()
+    _lock = threading.Lock()
+    MAX_CACHED = 10000
+
+    @staticmethod
+    def get_digest(endpoint: str, key: str) -> str:
+        """ The same key for different endpoints are different requests """
+        return hashlib.sha1(f'{endpoint}:{key}'.encode()).hexdigest()
+
+    @classmethod
+    def is_recent(cls, digest: str) -> bool:
+        """ Whether this process handled the key within the TTL """
+        with cls._lock:
+            expiry = cls._recent.get(digest)
+            if expiry is None:
+                return False
+            if expiry < time.monotonic():
+                del cls._recent[digest]
+                return False
+            cls._recent.move_to_end(digest)
+            return True
+
+    @classmethod
+    def _remember(cls, digest: str):
+        with cls._lock:
+            cls._recent[digest] = time.monotonic() + settings.INGRESS_KEY_TTL
+            cls._recent.move_to_end(digest)
+            while len(cls._recent) > cls.MAX_CACHED:
+                cls._recent.popitem(last=False)
+
+    @classmethod
+    def claim(cls, digest: str) -> bool:
+        """ Store the key, unless it was handled before
+            Call it in the transaction that handles the request : if that
+            fails the key is rolled back too, and the retry is handled
+
+            :param digest: see get_digest
+            :return: True if the request is to be handled
+        """
+        try:
+            with transaction.atomic():
+                cls.objects.create(digest=digest, timestamp=now_stamp())
+        except IntegrityError as _:
+            cls._remember(digest)
+            return False
+        transaction.on_commit(lambda: cls._remember(digest))
+        return True
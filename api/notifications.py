@@ -2,16 +2,18 @@ import json
 import logging
 import re
 import time
-from typing import Any, Dict, List
+from typing import TYPE_CHECKING, Any, Dict, List
 
 from background_task import background
 from django.conf import settings
-from django.contrib.auth.models import User
-from django.core.exceptions import ObjectDoesNotExist
-from onesignal import Client, Notification
 
 from api.ping import add_web_ping
+from core.metrics import ONESIGNAL, timed
 from core.models import Profile
+from core.users import get_user, invalidate
+
+if TYPE_CHECKING:
+    from onesignal import Client
 
 logger_debug = logging.getLogger('debug')
 logger_app = logging.getLogger('app')
@@ -21,8 +23,11 @@ class NotificationError(Exception):
     pass
 
 
-def _get_client() -> Client:
-    """ Connect to OneSignal """
+def _get_client() -> 'Client':
+    """ Connect to OneSignal
+        Imported here, most processes never send a notification
+    """
+    from onesignal import Client
     return Client(user_auth_key=settings.USER_AUTH_KEY,
                   app_auth_key=settings.APP_AUTH_KEY,
                   app_id=settings.APP_ID)
@@ -34,7 +39,8 @@ def _get_all_players() -> List[Dict[str, Any]]:
     players = []
     request_query = {'offset': 0}
     while True:
-        devices = json.loads(client.view_devices(request_query).text)
+        with timed(ONESIGNAL):
+            devices = json.loads(client.view_devices(request_query).text)
         players.extend(devices['players'])
         request_query['offset'] += 300
         if request_query['offset'] > devices['total_count']:
@@ -62,6 +68,7 @@ def retrieve_onesignal_ids():
     # Create or update profile if needed
     extra = {'origin': 'ONESIGNAL IDS'}
     profiles_dict = {p.sub_id: p for p in Profile.objects.all()}
+    changed = {}
     for player in players:
         sub_id = player['external_user_id']
         profile = profiles_dict.get(sub_id)
@@ -70,7 +77,12 @@ def retrieve_onesignal_ids():
                 f"Player {sub_id} doesn't have a profile yet", extra=extra)
         elif profile.onesignal_id != player['id']:
             profile.onesignal_id = player['id']
-            profile.save()
+            changed[profile.pk] = profile
+    Profile.objects.bulk_update(changed.values(), ['onesignal_id'],
+                                batch_size=500)
+    # A bulk update doesn't send the signals that keep the cache up to date
+    for profile in changed.values():
+        invalidate(profile.user_id)
 
 
 @background(schedule=0)
@@ -89,19 +101,19 @@ def send_notification(username: str, message: str = 'New message',
         add_web_ping(username)
 
     # Get the User profile from DB to get the OneSignal ID
-    try:
-        user = User.objects.get(username=username)
-        onesignal_id = user.profile.onesignal_id
-    except ObjectDoesNotExist as _:
+    user = get_user(username)
+    if user is None:
         # The demo version uses the IP address as username, no notifications
         if re.sub('[\d, \.]', '', username) == '':
             return
         raise NotificationError(f"Client '{username}' not known")
+    onesignal_id = user.profile.onesignal_id
     if not onesignal_id:
         logger_app.warning(f"Client '{username}' has no OneSignal ID",
                            extra={'origin': 'SEND NOTIFICATION'})
         return
 
+    from onesignal import Notification
     new_notification = Notification(post_body={
         'headings': {'en': '<TODO>'},
         'contents': {'en': message},
@@ -109,4 +121,5 @@ def send_notification(username: str, message: str = 'New message',
         'collapse_id': '<TODO>',
     })
     client = _get_client()
-    client.send_notification(new_notification)
+    with timed(ONESIGNAL):
+        client.send_notification(new_notification)
@@ -3,6 +3,7 @@ import time
 from pathlib import Path
 
 from core import settings
+from core.metrics import FILE, timed
 
 
 def _get_dir() -> Path:
@@ -14,6 +15,7 @@ def setup():
     os.makedirs(str(_get_dir()), exist_ok=True)
 
 
+@timed(FILE)
 def add_web_ping(username: str):
     long_file = _get_dir() / username
     long_file.touch(exist_ok=True)
@@ -24,8 +26,10 @@ def has_web_ping(username: str) -> bool:
     wait = 0.1
     count = (5 if settings.DEBUG else 120) / wait
     while count > 0:
+        # Only the file access, not the waiting
         try:
-            long_file.unlink()
+            with timed(FILE):
+                long_file.unlink()
             return True
         except FileNotFoundError as _:
             pass
@@ -4,11 +4,15 @@ from . import views
 
 urlpatterns = [
     path('messages/', views.sync_messages, name='messages'),
+    path('messages_async/', views.sync_messages_async,
+         name='messages_async'),
     path('ping/', views.ping, name='ping'),
     path('config/', views.config, name='config'),
     path('ingress/', views.ingress, name='ingress'),
+    path('ingress_batch/', views.ingress_batch, name='ingress_batch'),
     path('ingress_task/', views.ingress_task, name='ingress_task'),
     path('get_names/', views.get_names, name='get_names'),
+    path('metrics/', views.metrics, name='metrics'),
 
     # TODO Only here for legacy reasons
     path('add_task/', views.ingress_task, name='ingress_task'),
@@ -1,30 +1,42 @@
+from contextlib import nullcontext
 from datetime import datetime
 import json
 import logging
+from typing import Any, Dict, Optional, Tuple
 
-from background_task.models import Task, TaskManager
+from background_task.models import TaskManager
 from django.conf import settings
-from django.contrib.auth.models import User
 from django.core.handlers.wsgi import WSGIRequest
-from django.http import HttpResponse, JsonResponse
+from django.db import transaction
+from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest, \
+    HttpResponseNotAllowed, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from pytz import timezone
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import APIException, NotAuthenticated
 from rest_framework.request import Request
+from rest_framework.views import APIView
 
+from api.models import IngressKey
 from api.notifications import send_notification
 from api.ping import has_web_ping
-from chat.chat import handle_user_message
+from chat.chat import handle_user_message, handle_user_message_async
 from core.rasa import get_button_texts
-from chat.conversation import start_conversation
+from chat.conversation import get_scheduled_conversations, \
+    start_conversation
 from chat.models import ChatMessage
-from core.utils import now_stamp, log_chat
+from core.metrics import render
+from core.users import get_user
+from core.utils import in_db_thread, now_stamp, log_chat
 from core.models import Data, JsonKey
 
 logger_debug = logging.getLogger('debug')
 logger_app = logging.getLogger('app')
 
+# Sent by Rasa to the ingress endpoints, the same for a retried request
+IDEMPOTENCY_KEY = 'idempotency_key'
+
 
 @api_view(['POST'])
 def log(request: Request) -> HttpResponse:
@@ -84,24 +96,70 @@ def sync_messages(request: Request) -> JsonResponse:
             A list of configs the user needs to fill
     """
 
+    return handle_user_message(
+        _get_sync_data(request.data, request.user.username))
+
+
+async def sync_messages_async(request: HttpRequest) -> JsonResponse:
+    """ The main endpoint for the app, as sync_messages, but async
+        Served by an ASGI worker, the requests waiting for the bot share
+        its event loop instead of holding a worker (thread) each
+
+        :param request: The request from the app, should contain the token
+        :return: see sync_messages
+    """
+
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        username, request_data = await in_db_thread(_authenticate)(request)
+    except APIException as e:
+        return JsonResponse({'detail': e.detail}, status=e.status_code)
+
+    return await handle_user_message_async(
+        _get_sync_data(request_data, username))
+
+
+# The csrf_exempt decorator would hide that the view is async
+sync_messages_async.csrf_exempt = True
+
+
+def _authenticate(request: HttpRequest) -> Tuple[str, Dict[str, Any]]:
+    """ Authenticate and parse the request as the api_view views do
+
+        :param request: The request from the app, should contain the token
+        :return: the username and the data of the request
+    """
+    request = APIView().initialize_request(request)
+    if not request.user.is_authenticated:
+        raise NotAuthenticated()
+    return request.user.username, request.data
+
+
+def _get_sync_data(request_data: Dict[str, Any], username: str) -> Data:
     extra = {'origin': 'API VIEWS SYNC'}
-    logger_debug.info(f"{request.user.username} : {request.data}", extra=extra)
+    logger_debug.info(f"{username} : {request_data}", extra=extra)
 
     # Ensure / clean data
-    request.data[JsonKey.text] = request.data.get(JsonKey.text, '').strip()
-    request.data[JsonKey.username] = request.user.username
-    request.data[JsonKey.roomname] = request.data[JsonKey.username]
-    request.data[JsonKey.fromstamp] = request.data.get(JsonKey.fromstamp, 0)
+    request_data[JsonKey.text] = request_data.get(JsonKey.text, '').strip()
+    request_data[JsonKey.username] = username
+    request_data[JsonKey.roomname] = request_data[JsonKey.username]
+    request_data[JsonKey.fromstamp] = request_data.get(JsonKey.fromstamp, 0)
 
     # Users shouldn't be allowed to directly trigger actions via intents
-    if request.data[JsonKey.text].startswith('/restart') or \
-            request.data[JsonKey.text].startswith('EXTERNAL: '):
-        logger_app.warning(
-            f"{request.user.username} : {request.data[JsonKey.text]}",
-            extra={'origin': 'API VIEWS SYNC'})
-        request.data[JsonKey.text] = ''
+    if request_data[JsonKey.text].startswith('/restart') or \
+            request_data[JsonKey.text].startswith('EXTERNAL: '):
+        logger_app.warning(f"{username} : {request_data[JsonKey.text]}",
+                           extra=extra)
+        request_data[JsonKey.text] = ''
+
+    return Data(request_data)
 
-    return handle_user_message(Data(request.data))
+
+def _get_ingress_digest(request_data: Dict[str, Any],
+                        endpoint: str) -> Optional[str]:
+    key = request_data.get(IDEMPOTENCY_KEY)
+    return IngressKey.get_digest(endpoint, str(key)) if key else None
 
 
 @require_POST
@@ -112,6 +170,8 @@ def ingress(request: WSGIRequest) -> HttpResponse:
         But sometimes Rasa wants to interact (action via intent)
 
         :param request: The request from the bot, encoded as a message
+            Optionally with an idempotency_key, a retry with the same key
+            is only acknowledged
         :return: A simple acknowledgement if the ingress succeeded
             or a denial if there is no valid authentication
     """
@@ -120,16 +180,76 @@ def ingress(request: WSGIRequest) -> HttpResponse:
     if request_data.get('backend_secret') != settings.BACKEND_SECRET:
         return HttpResponse('Nope')
 
+    digest = _get_ingress_digest(request_data, 'ingress')
+    if digest and IngressKey.is_recent(digest):
+        return HttpResponse('OK')
+
     extra = {'origin': 'INGRESS CHAT'}
     logger_debug.info(request_data, extra=extra)
 
     request_data[JsonKey.timestamp] = now_stamp()
     request_data[JsonKey.username] = settings.CHAT_MASTER
-    chat_message = ChatMessage.from_data(Data(request_data))
-    chat_message.save()
+    # A keyed request in one transaction, the key is rolled back on failure
+    with transaction.atomic() if digest else nullcontext():
+        if digest and not IngressKey.claim(digest):
+            return HttpResponse('OK')
+        chat_message = ChatMessage.from_data(Data(request_data))
+        chat_message.save()
 
-    # Send notifications to device
-    send_notification(chat_message.roomname)
+        # Send notifications to device
+        send_notification(chat_message.roomname)
+
+    return HttpResponse('OK')
+
+
+@require_POST
+@csrf_exempt
+def ingress_batch(request: WSGIRequest) -> HttpResponse:
+    """ Ingress point for several chats from Rasa at once, e.g. all the
+        messages of an action, in the order they are to be shown
+        Stored in one transaction, with one notification per room
+
+        :param request: The request from the bot, with the messages in
+            a list, each with a roomname, text and optionally buttons
+            Optionally with an idempotency_key, as for ingress
+        :return: A simple acknowledgement if the ingress succeeded
+            or a denial if there is no valid authentication
+    """
+
+    request_data = json.loads(request.body)
+    if request_data.get('backend_secret') != settings.BACKEND_SECRET:
+        return HttpResponse('Nope')
+
+    messages = request_data.get(JsonKey.messages)
+    if not isinstance(messages, list) or not all(
+            isinstance(message, dict) and message.get(JsonKey.roomname)
+            and JsonKey.text in message for message in messages):
+        return HttpResponseBadRequest('Expected a list of messages, '
+                                      'each with a roomname and a text')
+
+    digest = _get_ingress_digest(request_data, 'ingress_batch')
+    if digest and IngressKey.is_recent(digest):
+        return HttpResponse('OK')
+
+    extra = {'origin': 'INGRESS BATCH'}
+    logger_debug.info(request_data, extra=extra)
+
+    # Consecutive timestamps keep the messages in order
+    timestamp = now_stamp()
+    chat_messages = []
+    with transaction.atomic():
+        if digest and not IngressKey.claim(digest):
+            return HttpResponse('OK')
+        for i, message in enumerate(messages):
+            message[JsonKey.timestamp] = timestamp + i
+            message[JsonKey.username] = settings.CHAT_MASTER
+            chat_messages.append(ChatMessage.from_data(Data(message)))
+        ChatMessage.objects.bulk_create(chat_messages)
+
+    # Send notifications to device, once per room
+    for roomname in dict.fromkeys(message.roomname
+                                  for message in chat_messages):
+        send_notification(roomname)
 
     return HttpResponse('OK')
 
@@ -141,6 +261,7 @@ def ingress_task(request: WSGIRequest) -> HttpResponse:
         This could be a delayed survey request
 
         :param request: The request from the bot
+            Optionally with an idempotency_key, as for ingress
         :return: A simple acknowledgement if the ingress succeeded
             or a denial if there is no valid authentication
     """
@@ -149,22 +270,32 @@ def ingress_task(request: WSGIRequest) -> HttpResponse:
     if request_data.get('backend_secret') != settings.BACKEND_SECRET:
         return HttpResponse('Nope')
 
-    if request_data.get('cancel'):
-        params = json.dumps(
-            [[request_data['task'], request_data['username']], {}])
-        for task in Task.objects.filter(task_name=start_conversation.name,
-                                        task_params=params):
-            task.delete()
-    else:
-        date_time = datetime.fromtimestamp(request_data['timestamp'])
-        request_data[date_time] = date_time.replace(tzinfo=timezone('UTC'))
-
-        task = TaskManager().new_task(start_conversation.name,
-                                      args=(request_data['task'],
-                                            request_data['username']),
-                                      run_at=request_data[date_time],
-                                      remove_existing_tasks=False)
-        task.save()
+    digest = _get_ingress_digest(request_data, 'ingress_task')
+    if digest and IngressKey.is_recent(digest):
+        return HttpResponse('OK')
+
+    # A keyed request in one transaction, the key is rolled back on failure
+    with transaction.atomic() if digest else nullcontext():
+        if digest and not IngressKey.claim(digest):
+            return HttpResponse('OK')
+
+        scheduled = get_scheduled_conversations(request_data['task'],
+                                                request_data['username'])
+        if request_data.get('cancel'):
+            scheduled.delete()
+        else:
+            date_time = datetime.fromtimestamp(request_data['timestamp'])
+            request_data[date_time] = \
+                date_time.replace(tzinfo=timezone('UTC'))
+
+            # Don't schedule the same conversation twice at the same time
+            if not scheduled.filter(run_at=request_data[date_time]).exists():
+                task = TaskManager().new_task(start_conversation.name,
+                                              args=(request_data['task'],
+                                                    request_data['username']),
+                                              run_at=request_data[date_time],
+                                              remove_existing_tasks=False)
+                task.save()
 
     extra = {'origin': 'INGRESS TASK'}
     logger_debug.info(request_data, extra=extra)
@@ -185,7 +316,7 @@ def get_names(request: WSGIRequest) -> JsonResponse:
     if request_data.get('backend_secret') != settings.BACKEND_SECRET:
         return JsonResponse({})
 
-    user = User.objects.get(username=request_data[JsonKey.username])
+    user = get_user(request_data[JsonKey.username])
     if not user:
         return JsonResponse({})
 
@@ -194,3 +325,18 @@ def get_names(request: WSGIRequest) -> JsonResponse:
         'last_name': user.last_name,
         'full_name': user.profile.full_name,
     })
+
+
+def metrics(request: WSGIRequest) -> HttpResponse:
+    """ Endpoint for Prometheus to scrape the timing metrics of all workers
+
+        :param request: The request, with the backend secret as bearer token
+        :return: The metrics in the Prometheus text format
+            or a denial if there is no valid authentication
+    """
+    authorization = request.headers.get('Authorization', '')
+    if authorization != f'Bearer {settings.BACKEND_SECRET}':
+        return HttpResponse('Nope')
+
+    return HttpResponse(render(),
+                        content_type='text/plain; version=0.0.4')
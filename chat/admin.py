@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import ChatMessage
+from .models import ArchivedChatMessage, ChatMessage
 
 
 class ChatMessageAdmin(admin.ModelAdmin):
@@ -8,3 +8,4 @@ class ChatMessageAdmin(admin.ModelAdmin):
 
 
 admin.site.register(ChatMessage, ChatMessageAdmin)
+admin.site.register(ArchivedChatMessage, ChatMessageAdmin)
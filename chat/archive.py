@@ -0,0 +1,40 @@
+import logging
+
+from background_task import background
+from django.conf import settings
+from django.db import transaction
+
+from chat.models import ArchivedChatMessage, ChatMessage
+from core.utils import now_stamp
+
+logger_app = logging.getLogger('app')
+
+
+@background
+def archive_messages():
+    """ Move the messages older than ARCHIVE_AGE to the archive table,
+        ARCHIVE_CHUNK at a time, so the chat table stays small
+    """
+    cutoff = now_stamp() - settings.ARCHIVE_AGE * 1000
+    fields = [field.attname for field in ChatMessage._meta.concrete_fields]
+
+    count = 0
+    while True:
+        # Oldest first, those have the lowest ids
+        with transaction.atomic():
+            chunk = list(ChatMessage.objects
+                         .filter(timestamp__lt=cutoff)
+                         .order_by('id')[:settings.ARCHIVE_CHUNK])
+            if not chunk:
+                break
+            ArchivedChatMessage.objects.bulk_create(
+                [ArchivedChatMessage(**{field: getattr(message, field)
+                                        for field in fields})
+                 for message in chunk])
+            ChatMessage.objects \
+                .filter(id__in=[message.id for message in chunk]).delete()
+        count += len(chunk)
+
+    if count:
+        logger_app.info(f"Archived {count} messages",
+                        extra={'origin': 'ARCHIVE'})
@@ -1,19 +1,27 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 import logging
-from typing import Dict, List, Union
+from typing import Dict, Iterable, List, Union
 
 from django.conf import settings
-from django.contrib.auth.models import User
 from django.http import JsonResponse
 
 from api.notifications import send_notification
 from core.config import Config
 from chat.models import ChatMessage, Button
-from core.rasa import send_to_factsbot, converse_with_rasa, set_rasa_names
-from core.utils import now_stamp
+from core.rasa import converse_with_rasa, converse_with_rasa_async, \
+    set_rasa_names, set_rasa_names_async
+from core.users import get_user
+from core.utils import in_db_thread, now_stamp
 from core.models import Data, JsonKey
 
 logger_app = logging.getLogger('app')
 
+# Pushes the names to Rasa during the welcome turn, threads start on first use
+_executor = ThreadPoolExecutor(max_workers=4,
+                               thread_name_prefix='welcome-names')
+
 
 def handle_user_message(data: Data) -> JsonResponse:
     """ Handle the message from the user, either from the API
@@ -50,14 +58,49 @@ def handle_user_message(data: Data) -> JsonResponse:
 
     # Make sure the names are re-set after a restart
     if data.text.startswith('/restart'):
-        users = User.objects.filter(username=data.username)
-        if users:
-            user = users[0]
+        user = get_user(data.username)
+        if user:
             set_rasa_names(user, data)
 
     return response
 
 
+async def handle_user_message_async(data: Data) -> JsonResponse:
+    """ handle_user_message for the async view
+        The config is retrieved during the turn with the bot, and after a
+        restart the names are re-set while the new messages are retrieved
+
+        :param data: the Data object from the user input
+        :return:
+            A list of new messages
+            A List of needed config items
+    """
+
+    if data.text == 'TEST':
+        return await in_db_thread(handle_test_message)(data)
+
+    # The config doesn't depend on the reply of the bot-backend
+    steps = [in_db_thread(Config.get_config)(data)]
+    if data.text:
+        steps.append(handle_message_async(data))
+    config, *_ = await asyncio.gather(*steps)
+
+    # Make sure the names are re-set after a restart
+    steps = [in_db_thread(get_messages)(data)]
+    if data.text.startswith('/restart'):
+        steps.append(set_names_async(data))
+    messages, *_ = await asyncio.gather(*steps)
+
+    # Apparently this is the first interaction from the user, show 'welcome'
+    if not config and not messages and data.fromstamp == 0:
+        messages = await get_welcome_message_async(data)
+
+    return JsonResponse({
+        JsonKey.messages: messages,
+        JsonKey.config: config,
+    })
+
+
 def handle_test_message(data: Data) -> JsonResponse:
     """ The user wants to test the client, reply with a test message.
         Also send a notification
@@ -79,15 +122,51 @@ def handle_test_message(data: Data) -> JsonResponse:
 
 def get_welcome_message(data: Data) \
         -> List[Dict[str, Union[int, str, List[Button]]]]:
+    """ Send the names to Rasa and get the welcome message, at the same time
+        Rasa gets the names via get_names if the turn needs them earlier
+
+        :param data: the Data object from the user input
+        :return: the welcome messages, the room was empty before
+    """
+
     # Send names to Rasa to be used by the surveys / responses
-    users = User.objects.filter(username=data.username)
-    if users:
-        user = users[0]
-        set_rasa_names(user, data)
+    # The profile is loaded here, the thread doesn't use the DB
+    user = get_user(data.username)
+    names = _executor.submit(copy_context().run, set_rasa_names, user, data) \
+        if user else None
+
+    data.text = '/request_welcome'
+    replies = converse_with_rasa(data)
+    if names:
+        names.result()
+    # Rasa failed, show what the room has instead of nothing
+    if not replies:
+        return get_messages(data)
+    return as_dicts(data, replies)
+
+
+async def get_welcome_message_async(data: Data) \
+        -> List[Dict[str, Union[int, str, List[Button]]]]:
+    """ get_welcome_message for the async view
+
+        :param data: the Data object from the user input
+        :return: the welcome messages, the room was empty before
+    """
 
     data.text = '/request_welcome'
-    converse_with_rasa(data)
-    return get_messages(data)
+    _, replies = await asyncio.gather(set_names_async(data),
+                                      converse_with_rasa_async(data))
+    # Rasa failed, show what the room has instead of nothing
+    if not replies:
+        return await in_db_thread(get_messages)(data)
+    return await in_db_thread(as_dicts)(data, replies)
+
+
+async def set_names_async(data: Data):
+    """ Send the names of the user to Rasa, from async code """
+    user = await in_db_thread(get_user)(data.username)
+    if user:
+        await set_rasa_names_async(user, data)
 
 
 def handle_message(data: Data):
@@ -98,14 +177,31 @@ def handle_message(data: Data):
         :param data: the Data object from the user input
     """
 
-    # Save message from user
-    chat_message = ChatMessage.from_data(data)
-    chat_message.save()
+    save_message(data)
 
     # Send to backend or Rasa
     converse_with_rasa(data, False)
 
 
+async def handle_message_async(data: Data):
+    """ handle_message for the async view
+
+        :param data: the Data object from the user input
+    """
+
+    await in_db_thread(save_message)(data)
+    await converse_with_rasa_async(data, False)
+
+
+def save_message(data: Data):
+    """ Save the message from the user
+
+        :param data: the Data object from the user input
+    """
+    chat_message = ChatMessage.from_data(data)
+    chat_message.save()
+
+
 def get_messages(data: Data) -> List[Dict[str, Union[int, str, List[Button]]]]:
     """ Get the messages (as dicts) from a room
 
@@ -113,5 +209,17 @@ def get_messages(data: Data) -> List[Dict[str, Union[int, str, List[Button]]]]:
         :return: A list of messages
     """
 
-    return [message.as_dict for message in
-            ChatMessage.get_room_messages(data)]
+    return as_dicts(data, ChatMessage.get_room_messages(data))
+
+
+def as_dicts(data: Data, messages: Iterable[ChatMessage]) \
+        -> List[Dict[str, Union[int, str, List[Button]]]]:
+    """ The messages as sent to the client, compact if it asked for that
+
+        :param data: the Data object from the user input
+        :param messages: the messages
+        :return: A list of messages
+    """
+
+    return [message.as_dict if data.markup else message.as_compact_dict
+            for message in messages]
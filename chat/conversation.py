@@ -1,13 +1,23 @@
-from datetime import datetime, timedelta
+from datetime import datetime
+import json
 
 from background_task import background
-from background_task.models import TaskManager
+from background_task.models import Task, TaskManager
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import QuerySet
 from pytz import timezone
 
+from chat.pacing import get_slot
+from core.config import ENGLISH, LANGUAGES
 from core.rasa import converse_with_rasa, set_rasa_names
 from core.models import Data, JsonKey
+from core.users import get_user
 from core.utils import log_chat
+from tasks.scheduler import wake_up
+
+# Rows per INSERT when creating tasks in bulk
+BULK_SIZE = 500
 
 
 @background
@@ -17,33 +27,40 @@ def schedule_conversation(conversation_name: str, username: str = None):
     Args:
         conversation_name: the name of the conversation to be scheduled
         username: the name of the user for which to schedule the conversation
-            if no username is given, schedule for all users 1 minute apart
+            if no username is given, schedule for all users, paced to
+            what the Rasa bot of their language can handle
 
     """
-    def is_mobile_user(user):
-        return user.profile and user.profile.onesignal_id
-
     now = datetime.now().replace(tzinfo=timezone('UTC'))
     users = User.objects.filter(username=username)
-    if not users:
-        users = [user for user in User.objects.all()]
+    if username is None or not users.exists():
+        users = User.objects.all()
 
-    delta = 0
-    for user in users:
-        # Only schedule mobile users, unless it's restart
-        if not is_mobile_user(user) and conversation_name != '/restart':
-            continue
+    # Only schedule mobile users, unless it's restart
+    if conversation_name != '/restart':
+        users = users.filter(profile__onesignal_id__gt='')
+    users = users.order_by('pk').values_list('username', 'profile__config_str')
 
+    task_manager = TaskManager()
+    new_tasks = []
+    for user_name, config_str in users:
+        config = json.loads(config_str or '{}')
         # Spread the conversations, unless it's a restart
-        if conversation_name != '/restart':
-            delta += 10
-
-        date_time = now + timedelta(seconds=delta)
-        task = TaskManager().new_task(start_conversation.name,
-                                      args=(conversation_name, user.username),
-                                      run_at=date_time,
-                                      remove_existing_tasks=False)
-        task.save()
+        # Users without config won't be contacted, no need to wait for them
+        if conversation_name != '/restart' and config:
+            language = config.get(JsonKey.language, ENGLISH)
+            date_time = get_slot(LANGUAGES[language]['port'], now)
+        else:
+            date_time = now
+
+        new_tasks.append(
+            task_manager.new_task(start_conversation.name,
+                                  args=(conversation_name, user_name),
+                                  run_at=date_time,
+                                  remove_existing_tasks=False))
+    Task.objects.bulk_create(new_tasks, batch_size=BULK_SIZE)
+    # A bulk insert doesn't send post_save, announce the tasks here
+    transaction.on_commit(wake_up)
 
 
 @background
@@ -58,7 +75,9 @@ def start_conversation(conversation_name: str, username: str):
         username: the name of the user for which to start the conversation
 
     """
-    user = User.objects.get(username=username)
+    user = get_user(username)
+    if user is None:
+        raise User.DoesNotExist(f"User '{username}' not known")
     profile = user.profile
     config = profile.config
 
@@ -77,8 +96,23 @@ def start_conversation(conversation_name: str, username: str):
         set_rasa_names(user, data)
 
     # Log the conversation
-    chat_dict = data.__dict__
+    chat_dict = data.as_dict()
     chat_dict[JsonKey.roomname] = username
     log_chat(chat_dict)
 
     converse_with_rasa(data)
+
+
+def get_scheduled_conversations(conversation_name: str,
+                                username: str) -> QuerySet:
+    """ Get the pending start_conversation tasks for a user
+        Looked up via the task hash (indexed), which background_task
+        derives from the task name and params
+
+    Args:
+        conversation_name: the name of the scheduled conversation
+        username: the name of the user for which it's scheduled
+
+    """
+    return Task.objects.get_task(start_conversation.name,
+                                 args=(conversation_name, username))
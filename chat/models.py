@@ -1,10 +1,13 @@
+import hashlib
 import json
 from dataclasses import dataclass
-from typing import Dict, Union, List
+import threading
+from typing import Dict, Iterable, List, Optional, Union
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 
-from core.utils import date_string, log_chat
+from core.utils import date_string, log_chat, now_stamp
 from core.models import Data, JsonKey
 from core.config import Color
 
@@ -15,17 +18,115 @@ class Button:
     payload: str = ''
 
 
-class ChatMessage(models.Model):
+class ButtonSet(models.Model):
+    """ A list of buttons, stored once and shared by all messages with
+        exactly these buttons (e.g. the answers of a survey scale)
+        Never changes, so the parsed buttons are cached per process, once
+        they are committed
+    """
+    # SHA1 of the buttons JSON
+    digest = models.CharField(max_length=40, unique=True)
+    buttons_str = models.TextField()
+
+    # The parsed buttons by id, and the ids by digest
+    _buttons: Dict[int, List[Dict[str, str]]] = {}
+    _ids: Dict[str, int] = {}
+    _lock = threading.Lock()
+    # Button sets repeat a lot, this limit is only hit by a misbehaving bot
+    MAX_CACHED = 10000
+
+    @staticmethod
+    def get_digest(buttons_str: str) -> str:
+        return hashlib.sha1(buttons_str.encode()).hexdigest()
+
+    @classmethod
+    def _cache(cls, sets: Dict[int, List[Dict[str, str]]],
+               ids: Dict[str, int]):
+        """ Cache the sets once the transaction that read or stored them
+            committed, a set of a rolled back transaction doesn't exist
+        """
+        def cache():
+            with cls._lock:
+                if len(cls._buttons) + len(sets) > cls.MAX_CACHED:
+                    cls._buttons.clear()
+                    cls._ids.clear()
+                cls._buttons.update(sets)
+                cls._ids.update(ids)
+
+        transaction.on_commit(cache)
+
+    @classmethod
+    def intern(cls, buttons: List[Dict[str, str]]) -> Optional[int]:
+        """ Get the id of the set with these buttons, stored if it's new
+
+            :return: the id, None if there are no buttons
+        """
+        if not buttons:
+            return None
+        buttons_str = json.dumps(buttons, sort_keys=True)
+        digest = cls.get_digest(buttons_str)
+        with cls._lock:
+            set_id = cls._ids.get(digest)
+        if set_id is None:
+            button_set, _ = cls.objects.get_or_create(
+                digest=digest, defaults={'buttons_str': buttons_str})
+            set_id = button_set.id
+            cls._cache({set_id: json.loads(buttons_str)}, {digest: set_id})
+        return set_id
+
+    @classmethod
+    def load(cls, set_ids: Iterable[Optional[int]]) \
+            -> Dict[int, List[Dict[str, str]]]:
+        """ Get the parsed buttons of the sets, those that aren't cached
+            with a single query
+
+            :return: the parsed buttons by set id
+        """
+        sets = {}
+        with cls._lock:
+            for set_id in set_ids:
+                if set_id is not None:
+                    sets[set_id] = cls._buttons.get(set_id)
+        missing = [set_id for set_id, buttons in sets.items()
+                   if buttons is None]
+        if missing:
+            ids = {}
+            for set_id, digest, buttons_str in cls.objects \
+                    .filter(id__in=missing) \
+                    .values_list('id', 'digest', 'buttons_str'):
+                sets[set_id] = json.loads(buttons_str)
+                ids[digest] = set_id
+            cls._cache({set_id: sets[set_id] for set_id in ids.values()}, ids)
+        return sets
+
+    @classmethod
+    def get_buttons(cls, set_id: int) -> List[Dict[str, str]]:
+        """ The parsed buttons, shared : don't modify them """
+        return cls.load([set_id])[set_id]
+
+
+class BaseChatMessage(models.Model):
+    """ The fields and representations shared by the recent messages and
+        the archived ones
+    """
+    class Meta:
+        abstract = True
+
     # Unique ID of the user (ERNA or HR equivalent)
     roomname = models.CharField(max_length=200)
     # Name of the originator, either roomname or 'bot'
     username = models.CharField(max_length=200)
     # Text of the message
     text = models.TextField()
-    # Optionally the list of buttons
-    buttons_str = models.TextField()
+    # Optionally the list of buttons, as a ButtonSet or for older messages
+    # as JSON in buttons_str
+    buttons_str = models.TextField(blank=True)
+    button_set = models.ForeignKey(ButtonSet, null=True, blank=True,
+                                   on_delete=models.PROTECT, related_name='+')
     # Time of sending, miliseconds
     timestamp = models.BigIntegerField()
+    # Optionally the index of the Color of the text
+    color = models.PositiveSmallIntegerField(null=True, blank=True)
 
     """ TODO Where to put this?
         Buttons allows a last item with payload = 'Type out your own message...'
@@ -47,17 +148,38 @@ class ChatMessage(models.Model):
 
     @property
     def buttons(self) -> List[Dict[str, str]]:
+        if self.button_set_id is not None:
+            return ButtonSet.get_buttons(self.button_set_id)
         if not self.buttons_str:
             return []
         return json.loads(self.buttons_str) or []
 
+    @property
+    def markup_text(self) -> str:
+        """ The text with the color as inline markup, for older clients """
+        if self.color is None:
+            return self.text
+        return f"<span style='{Color.from_index(self.color).style}'>" \
+               f"{self.text}</span>"
+
     @property
     def as_dict(self) -> Dict[str, Union[int, str, List[Button]]]:
         return {JsonKey.username: self.username,
-                JsonKey.text: self.text,
+                JsonKey.text: self.markup_text,
                 JsonKey.buttons: self.buttons,
                 JsonKey.timestamp: self.timestamp}
 
+    @property
+    def as_compact_dict(self) -> Dict[str, Union[int, str, List[Button]]]:
+        """ Without markup, the color (if any) as a separate value """
+        chat_dict = {JsonKey.username: self.username,
+                     JsonKey.text: self.text,
+                     JsonKey.buttons: self.buttons,
+                     JsonKey.timestamp: self.timestamp}
+        if self.color is not None:
+            chat_dict[JsonKey.color] = Color.from_index(self.color).value
+        return chat_dict
+
     @property
     def as_dict_log(self) -> Dict[str, Union[int, str, List[Button]]]:
         return {JsonKey.username: self.username,
@@ -65,18 +187,29 @@ class ChatMessage(models.Model):
                 JsonKey.text: self.text,
                 JsonKey.timestamp: self.timestamp}
 
+
+class ChatMessage(BaseChatMessage):
+    class Meta:
+        # Sync and export get the messages of a room by time
+        indexes = [models.Index(fields=['roomname', 'timestamp'])]
+
     @staticmethod
     def from_data(data: Data, color: Color = None) -> 'ChatMessage':
-        # Add color to utterances if needed
-        if color and '<span style=' not in data['text']:
-            data['text'] = f"<span style='color: {color.value};'>" \
+        # Add color to utterances if needed : plain text keeps it in a column,
+        # text with markup of its own is wrapped
+        color_index = None
+        if color and '<' not in data['text']:
+            color_index = color.index
+        elif color and '<span style=' not in data['text']:
+            data['text'] = f"<span style='{color.style}'>" \
                            f"{data['text']}</span>"
 
         chat = ChatMessage(roomname=data.roomname,
                            username=data.username,
                            text=data.text,
                            timestamp=data.timestamp,
-                           buttons_str=json.dumps(data.buttons or []))
+                           color=color_index,
+                           button_set_id=ButtonSet.intern(data.buttons))
 
         # Log the message
         log_chat(chat.as_dict_log)
@@ -84,8 +217,33 @@ class ChatMessage(models.Model):
         return chat
 
     @classmethod
-    def get_room_messages(cls, data: Data) -> List['ChatMessage']:
-        """ Get all the (new) messages for a room """
-        return cls.objects \
-            .filter(roomname=data.roomname, timestamp__gt=data.fromstamp) \
-            .order_by('timestamp')
+    def get_room_messages(cls, data: Data) -> List[BaseChatMessage]:
+        """ Get all the (new) messages for a room
+            Only looks in the archive if fromstamp goes back that far
+        """
+        messages = list(cls.objects
+                        .filter(roomname=data.roomname,
+                                timestamp__gt=data.fromstamp)
+                        .order_by('timestamp'))
+        if data.fromstamp < now_stamp() - settings.ARCHIVE_AGE * 1000:
+            # Read after the recent ones : a message that is archived in
+            # between is in both, and kept once. The other way around, it
+            # wouldn't be in either
+            ids = {message.id for message in messages}
+            archived = [message for message in ArchivedChatMessage.objects
+                        .filter(roomname=data.roomname,
+                                timestamp__gt=data.fromstamp)
+                        .order_by('timestamp')
+                        if message.id not in ids]
+            messages = archived + messages
+
+        ButtonSet.load(message.button_set_id for message in messages)
+        return messages
+
+
+class ArchivedChatMessage(BaseChatMessage):
+    """ Messages older than ARCHIVE_AGE, moved by archive_messages
+        Keeps the id of the ChatMessage
+    """
+    class Meta:
+        indexes = [models.Index(fields=['roomname', 'timestamp'])]
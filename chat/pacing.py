@@ -0,0 +1,131 @@
+from datetime import datetime, timedelta
+import json
+from typing import Any, Callable, Dict, Optional
+
+from django.conf import settings
+
+from core.config import ENGLISH, LANGUAGES
+from core.models import JsonKey, Profile
+
+
+class TokenBucket:
+    """ Token bucket that hands out time slots instead of tokens :
+        the first `burst` slots are right away, then one per 1 / rate seconds
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        # The time the bucket is empty again (theoretical arrival time)
+        self._tat: Optional[datetime] = None
+
+    def next_slot(self, now: datetime, rate: float = None) -> datetime:
+        """ Claim the first free slot from now on
+
+            :param now: the current time
+            :param rate: optionally overrides the rate for this slot
+            :return: the time of the slot
+        """
+        interval = timedelta(seconds=1 / (rate or self.rate))
+        tat = max(self._tat or now, now)
+        slot = max(now, tat - interval * (self.burst - 1))
+        self._tat = tat + interval
+        return slot
+
+
+# One bucket per Rasa port (i.e. language), shared by the fan-outs of this
+# process. It only spreads the start times, the Pacer of the task runner
+# limits what the bot gets at the same time
+_buckets: Dict[int, TokenBucket] = {}
+
+
+def get_slot(port: int, now: datetime) -> datetime:
+    """ Get the time to start the next conversation with a Rasa bot
+
+        :param port: port of the Rasa bot
+        :param now: the current time
+        :return: the time to start the conversation
+    """
+    if port not in _buckets:
+        _buckets[port] = TokenBucket(settings.RASA_PACING['rate'],
+                                     settings.RASA_PACING['burst'])
+    return _buckets[port].next_slot(now)
+
+
+class Pacer:
+    """ Limits the conversations started at the same time per Rasa bot
+        Used by the task runner, the one process that dispatches the tasks
+        of all fan-outs, so they share the capacity of the bot. A slot is
+        free as soon as a turn finished, so the throughput follows the
+        current latency of the bot : concurrency / latency
+    """
+
+    def __init__(self, concurrency: int = None):
+        self.concurrency = concurrency or settings.RASA_PACING['concurrency']
+        # {port: number of running tasks}
+        self._running: Dict[int, int] = {}
+        # {task id: port}
+        self._ports: Dict[int, int] = {}
+
+    @staticmethod
+    def get_port(task_name: str, arguments: Dict[str, Any]) -> Optional[int]:
+        """ The port of the Rasa bot a task talks to, if it's paced
+
+            :param task_name: the name of the task
+            :param arguments: the arguments of the task by parameter name
+            :return: the port, None if the task isn't paced
+        """
+        # Imported here, the conversations are scheduled with get_slot
+        from chat.conversation import start_conversation
+
+        # As schedule_conversation : a restart isn't spread, and users
+        # without config aren't contacted
+        if task_name != start_conversation.name \
+                or arguments.get('conversation_name') == '/restart':
+            return None
+        # From the DB, the language might have changed since it was scheduled
+        config_str = Profile.objects \
+            .filter(user__username=arguments.get('username')) \
+            .values_list('config_str', flat=True).first()
+        config = json.loads(config_str or '{}')
+        if not config:
+            return None
+        return LANGUAGES[config.get(JsonKey.language, ENGLISH)]['port']
+
+    def acquire(self, task_id: int, port: int) -> bool:
+        """ Take a slot of the bot for the task, if one is free
+
+            :param task_id: the id of the task
+            :param port: port of the Rasa bot
+            :return: True if the task can run now, also if it has a slot
+        """
+        if task_id in self._ports:
+            return True
+        if self._running.get(port, 0) >= self.concurrency:
+            return False
+        self._running[port] = self._running.get(port, 0) + 1
+        self._ports[task_id] = port
+        return True
+
+    def release(self, task_id: int) -> Optional[int]:
+        """ Free the slot of a finished task
+
+            :param task_id: the id of the task
+            :return: the port of the freed slot, None if it had none
+        """
+        port = self._ports.pop(task_id, None)
+        if port is not None:
+            self._running[port] -= 1
+        return port
+
+    def retain(self, is_running: Callable[[int], bool]) -> int:
+        """ Free the slots of the tasks that aren't running anymore,
+            which would otherwise block their bot for good
+
+            :param is_running: whether the task with the id is running
+            :return: the number of slots that were freed
+        """
+        gone = [task_id for task_id in self._ports if not is_running(task_id)]
+        for task_id in gone:
+            self.release(task_id)
+        return len(gone)
@@ -1,10 +1,24 @@
+import os
+
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
 
 
 class CoreConfig(AppConfig):
     name = 'core'
 
     def ready(self):
+        # Every process logs, before the log files are opened
+        for handler in settings.LOGGING['handlers'].values():
+            os.makedirs(os.path.dirname(handler['filename']), exist_ok=True)
+
+        # Before any connection is opened, also those of other threads
+        from core.metrics import time_queries
+        connection_created.connect(time_queries)
+        # Connects the signals that keep the cache of the users up to date
+        import core.users  # noqa: F401
+
         from core.utils import is_extra_process
         if is_extra_process('core'):
             return
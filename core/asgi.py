@@ -0,0 +1,15 @@
+""" ASGI entry point, for the async views (api/messages_async/)
+    E.g. gunicorn -c core/gunicorn.py -k uvicorn.workers.UvicornWorker core.asgi
+"""
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+
+application = get_asgi_application()
+
+# Once the apps are loaded
+from core.rasa import share_async_clients  # noqa: E402
+
+share_async_clients()
@@ -5,9 +5,10 @@ from pathlib import Path
 from typing import Any, Dict, List
 
 from django.conf import settings
-from django.contrib.auth.models import User
 
+from core.metrics import FILE, timed
 from core.models import Profile, Data, JsonKey
+from core.users import get_user
 
 ENGLISH = 'EN'  # This will be used as default
 DUTCH = 'NL'
@@ -33,12 +34,26 @@ INSTITUTIONS = {
 
 
 class Color(Enum):
+    # Stored by position in ChatMessage.color, only add colors at the end
+
     # Sync with Rasa
     OPTIONAL = 'blue'
     # Should not be needed in API, Rasa should provide these
     REQUIRED = 'darkgreen'
     SYSTEM = 'black'
 
+    @property
+    def index(self) -> int:
+        return list(Color).index(self)
+
+    @property
+    def style(self) -> str:
+        return f'color: {self.value};'
+
+    @staticmethod
+    def from_index(index: int) -> 'Color':
+        return list(Color)[index]
+
 
 class LanguageError(Exception):
     pass
@@ -54,19 +69,19 @@ class Config:
         base_dir = Path(os.path.dirname(__file__)).parents[0]
         return base_dir / '_data' / 'config'
 
-    @staticmethod
-    def setup():
+    @classmethod
+    def setup(cls):
         # Make sure dir exists, clear old files
-        base_dir = Path(os.path.dirname(__file__)).parents[0]
-        Config.__CONF_DIR = base_dir / '_data' / 'config'
-        os.makedirs(Config.__CONF_DIR, exist_ok=True)
-        for file in Config.__CONF_DIR.glob('*'):
+        config_dir = cls._config_dir()
+        os.makedirs(config_dir, exist_ok=True)
+        for file in config_dir.glob('*'):
             file.unlink()
 
         # Fill from DB
-        for profile in Profile.objects.all():
-            if profile.config:
-                (Config.__CONF_DIR / profile.user.username).touch(exist_ok=True)
+        usernames = Profile.objects.exclude(config_str__in=['', '{}']) \
+            .values_list('user__username', flat=True)
+        for username in usernames:
+            (config_dir / username).touch(exist_ok=True)
 
     @staticmethod
     def get_rasa_url(data: Data) -> str:
@@ -82,21 +97,21 @@ class Config:
     def get_config(cls, data: Data) -> List[Dict[str, Any]]:
         # User already provided all and didn't delete client side
         file_path = cls._config_dir() / data.username
-        if file_path.is_file() and data.language is not None:
-            with open(file_path, 'r') as f:
-                if json.loads(f.read() or '[]') == data.config():
-                    return []
+        with timed(FILE):
+            if file_path.is_file() and data.language is not None:
+                with open(file_path, 'r') as f:
+                    if json.loads(f.read() or '[]') == data.config():
+                        return []
 
         # User provided all needed config : save to DB and file
         if None not in data.config().values():
-            users = User.objects.filter(username=data.username)
-            if users:
-                user = users[0]
-                profile = Profile.objects.get(user=user)
+            user = get_user(data.username)
+            if user:
+                profile = user.profile
                 profile.config_str = json.dumps(data.config())
-                profile.save()
+                profile.save(update_fields=['config_str'])
 
-                with open(file_path, 'w') as f:
+                with timed(FILE), open(file_path, 'w') as f:
                     json.dump(data.config(), f)
 
                 return []
@@ -0,0 +1,28 @@
+""" Gunicorn settings : gunicorn -c core/gunicorn.py core.wsgi
+    or with an ASGI worker class for core.asgi, see there
+
+    The app is loaded and initialised once, in the master process, the
+    workers are forked from it and share its memory (copy-on-write)
+"""
+import multiprocessing
+import os
+import random
+
+bind = os.getenv('GUNICORN_BIND', '127.0.0.1:8000')
+workers = int(os.getenv('GUNICORN_WORKERS',
+                        2 * multiprocessing.cpu_count() + 1))
+preload_app = True
+
+# Lets the AppConfigs skip the lock files, there is only one app load
+os.environ['GUNICORN_PRELOAD'] = '1'
+
+
+def pre_fork(server, worker):
+    # The workers open their own DB connection, not the master's
+    from django.db import connections
+    connections.close_all()
+
+
+def post_fork(server, worker):
+    # Otherwise every worker samples the same requests for profiling
+    random.seed()
@@ -0,0 +1,137 @@
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import tracemalloc
+from typing import Callable, Iterator, List, Optional
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpRequest, HttpResponse
+
+from core.utils import HybridMiddleware, hybrid_middleware
+
+logger_app = logging.getLogger('app')
+
+# Depth of the traceback stored per allocation
+FRAMES = 1
+# Number of allocation sites reported
+TOP = 10
+# Leave out the allocations of the tracking itself
+FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+# The peak is process wide : it's only reset, and reported, for a
+# measurement that starts while no other one is running
+_lock = threading.Lock()
+_running = 0
+
+
+def get_rss() -> int:
+    """ Resident set size of this process in bytes, 0 if unknown """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError) as _:
+        return 0
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def _kb(size: int) -> str:
+    return f'{size / 1024:,.1f} KiB'
+
+
+class Measurement:
+    """ The memory use of a tracked block, filled in when the block exits """
+
+    def __init__(self, name: str):
+        self.name = name
+        # Highest traced memory during the block, above that at its start
+        # None if it started during another measurement
+        self.peak: Optional[int] = None
+        self.rss_delta = 0
+        # The allocation sites that grew the most, as 'file:line: size ...'
+        self.top: List[str] = []
+
+    def report(self) -> str:
+        peak = 'unknown' if self.peak is None else _kb(self.peak)
+        lines = [f'{self.name} : peak {peak}, '
+                 f'RSS {"+" if self.rss_delta >= 0 else ""}'
+                 f'{_kb(self.rss_delta)}']
+        lines += [f'    {site}' for site in self.top]
+        return '\n'.join(lines)
+
+
+@contextmanager
+def tracked(name: str) -> Iterator[Measurement]:
+    """ Measure the peak allocation, RSS delta and top allocation sites of
+        the block, and log them. Starts tracemalloc if it isn't running
+
+        The traced memory is process wide, so with threaded or async workers
+        the allocations of concurrent requests are included. The peak of a
+        block that starts while another one is tracked isn't known
+
+        :param name: the endpoint or command, used in the report
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(FRAMES)
+
+    global _running
+    measurement = Measurement(name)
+    before = tracemalloc.take_snapshot().filter_traces(FILTERS)
+    rss = get_rss()
+    with _lock:
+        alone = _running == 0
+        _running += 1
+        # Python 3.9+, older versions report the peak since tracing started
+        if alone and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+    try:
+        yield measurement
+    finally:
+        with _lock:
+            _running -= 1
+            _, peak = tracemalloc.get_traced_memory()
+        if alone:
+            measurement.peak = max(peak - start, 0)
+        measurement.rss_delta = get_rss() - rss
+        after = tracemalloc.take_snapshot().filter_traces(FILTERS)
+        measurement.top = [str(stat) for stat in
+                           after.compare_to(before, 'lineno')[:TOP]]
+        logger_app.info(measurement.report(), extra={'origin': 'MEMORY'})
+
+
+class MemoryMiddleware(HybridMiddleware):
+    """ Track the memory of each request when MEMORY_TRACKING is on
+        Removed from the middleware chain otherwise
+    """
+
+    def __init__(self, get_response: Callable):
+        if not settings.MEMORY_TRACKING:
+            raise MiddlewareNotUsed()
+        super().__init__(get_response)
+
+    def call(self, request: HttpRequest) -> HttpResponse:
+        with tracked(request.path) as measurement:
+            response = self.get_response(request)
+            self._rename(request, measurement)
+        return response
+
+    async def acall(self, request: HttpRequest) -> HttpResponse:
+        with tracked(request.path) as measurement:
+            response = await self.get_response(request)
+            self._rename(request, measurement)
+        return response
+
+    @staticmethod
+    def _rename(request: HttpRequest, measurement: Measurement):
+        match = request.resolver_match
+        if match:
+            measurement.name = match.route
+
+
+memory_middleware = hybrid_middleware(MemoryMiddleware)
@@ -0,0 +1,249 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.http import HttpRequest, HttpResponse
+
+from core.utils import HybridMiddleware, hybrid_middleware
+
+# The parts of a request that are timed separately
+DB = 'db'
+RASA = 'rasa'
+ONESIGNAL = 'onesignal'
+FILE = 'file'
+PARTS = (DB, RASA, ONESIGNAL, FILE)
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+# The timings of the current request, None outside requests
+# A context variable, as async requests share a thread and their sync parts
+# run in other threads (sync_to_async copies the context)
+_timings: ContextVar[Optional[Dict[str, List[float]]]] = \
+    ContextVar('timings', default=None)
+
+# Metrics of this process : {endpoint: {name: histogram or counter}}
+_metrics: Dict[str, Dict[str, Any]] = {}
+_lock = threading.Lock()
+_last_dump = 0.0
+
+
+def _get_dir() -> Path:
+    base_dir = Path(os.path.dirname(__file__)).parents[0]
+    return base_dir / '_data' / 'metrics'
+
+
+@contextmanager
+def timed(part: str):
+    """ Add the time spent in the block (or decorated function) to the
+        given part of the current request, no-op outside of requests
+
+        :param part: one of PARTS
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[part][0] += time.perf_counter() - start
+        timings[part][1] += 1
+
+
+def _time_query(execute: Callable, sql: str, params: Any, many: bool,
+                context: Dict[str, Any]) -> Any:
+    with timed(DB):
+        return execute(sql, params, many, context)
+
+
+def time_queries(sender, connection: BaseDatabaseWrapper, **kwargs):
+    """ Time the queries of a new DB connection, whichever thread it is in
+        Receiver of the connection_created signal
+    """
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+def _new_histogram() -> Dict[str, Any]:
+    return {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+
+
+def _observe(histogram: Dict[str, Any], seconds: float):
+    index = bisect_left(BUCKETS, seconds)
+    if index < len(BUCKETS):
+        histogram['buckets'][index] += 1
+    histogram['sum'] += seconds
+    histogram['count'] += 1
+
+
+def _record(endpoint: str, status: int, seconds: float,
+            timings: Dict[str, List[float]]):
+    with _lock:
+        metrics = _metrics.setdefault(endpoint, {
+            'seconds': _new_histogram(),
+            'parts': {part: _new_histogram() for part in PARTS},
+            'calls': {part: 0 for part in PARTS},
+            'status': {},
+        })
+        _observe(metrics['seconds'], seconds)
+        for part, (part_seconds, calls) in timings.items():
+            _observe(metrics['parts'][part], part_seconds)
+            metrics['calls'][part] += calls
+        status = str(status)
+        metrics['status'][status] = metrics['status'].get(status, 0) + 1
+
+
+def _dump(force: bool = False):
+    """ Write the metrics of this process, for the other workers to collect
+        At most once a second, unless forced
+    """
+    global _last_dump
+    now = time.time()
+    if not force and now - _last_dump < 1:
+        return
+    _last_dump = now
+
+    os.makedirs(str(_get_dir()), exist_ok=True)
+    file_path = _get_dir() / f'{os.getpid()}.json'
+    with _lock:
+        data = json.dumps(_metrics)
+    with open(f'{file_path}.tmp', 'w') as f:
+        f.write(data)
+    os.replace(f'{file_path}.tmp', file_path)
+
+
+def collect() -> Dict[str, Dict[str, Any]]:
+    """ Merge the metrics of all (current and past) worker processes """
+    _dump(force=True)
+    merged = {}
+    for file_path in _get_dir().glob('*.json'):
+        try:
+            with open(file_path, 'r') as f:
+                worker_metrics = json.loads(f.read() or '{}')
+        except (FileNotFoundError, ValueError) as _:
+            continue
+        for endpoint, metrics in worker_metrics.items():
+            if endpoint not in merged:
+                merged[endpoint] = metrics
+                continue
+            target = merged[endpoint]
+            histograms = [(target['seconds'], metrics['seconds'])] + \
+                [(target['parts'][p], metrics['parts'][p]) for p in PARTS]
+            for total, histogram in histograms:
+                total['buckets'] = [a + b for a, b in
+                                    zip(total['buckets'], histogram['buckets'])]
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+            for part in PARTS:
+                target['calls'][part] += metrics['calls'][part]
+            for status, count in metrics['status'].items():
+                target['status'][status] = \
+                    target['status'].get(status, 0) + count
+    return merged
+
+
+def _histogram_lines(name: str, labels: str,
+                     histogram: Dict[str, Any]) -> List[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(BUCKETS, histogram['buckets']):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+    lines.append(f'{name}_sum{{{labels}}} {histogram["sum"]}')
+    lines.append(f'{name}_count{{{labels}}} {histogram["count"]}')
+    return lines
+
+
+def render() -> str:
+    """ All metrics in the Prometheus text format """
+    metrics = collect()
+    lines = [
+        '# HELP api_request_seconds Latency of the requests per endpoint',
+        '# TYPE api_request_seconds histogram',
+    ]
+    for endpoint, endpoint_metrics in sorted(metrics.items()):
+        labels = f'endpoint="{endpoint}"'
+        lines += _histogram_lines('api_request_seconds', labels,
+                                  endpoint_metrics['seconds'])
+
+    lines += [
+        '# HELP api_request_part_seconds Time per request spent in a part',
+        '# TYPE api_request_part_seconds histogram',
+    ]
+    for endpoint, endpoint_metrics in sorted(metrics.items()):
+        for part in PARTS:
+            labels = f'endpoint="{endpoint}",part="{part}"'
+            lines += _histogram_lines('api_request_part_seconds', labels,
+                                      endpoint_metrics['parts'][part])
+
+    lines += [
+        '# HELP api_part_calls_total Number of calls to a part',
+        '# TYPE api_part_calls_total counter',
+    ]
+    for endpoint, endpoint_metrics in sorted(metrics.items()):
+        for part in PARTS:
+            lines.append(f'api_part_calls_total{{endpoint="{endpoint}",'
+                         f'part="{part}"}} {endpoint_metrics["calls"][part]}')
+
+    lines += [
+        '# HELP api_requests_total Number of requests per response status',
+        '# TYPE api_requests_total counter',
+    ]
+    for endpoint, endpoint_metrics in sorted(metrics.items()):
+        for status, count in sorted(endpoint_metrics['status'].items()):
+            lines.append(f'api_requests_total{{endpoint="{endpoint}",'
+                         f'status="{status}"}} {count}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class TimingMiddleware(HybridMiddleware):
+    """ Time each request, and the DB, Rasa, OneSignal and file I/O parts """
+
+    def call(self, request: HttpRequest) -> HttpResponse:
+        timings = {part: [0.0, 0] for part in PARTS}
+        token = _timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            seconds = time.perf_counter() - start
+            _timings.reset(token)
+
+        self._record(request, response, seconds, timings)
+        return response
+
+    async def acall(self, request: HttpRequest) -> HttpResponse:
+        timings = {part: [0.0, 0] for part in PARTS}
+        token = _timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            seconds = time.perf_counter() - start
+            _timings.reset(token)
+
+        self._record(request, response, seconds, timings)
+        return response
+
+    @staticmethod
+    def _record(request: HttpRequest, response: HttpResponse, seconds: float,
+                timings: Dict[str, List[float]]):
+        match = request.resolver_match
+        endpoint = match.route if match else 'unmatched'
+        _record(endpoint, response.status_code, seconds, timings)
+        _dump()
+
+
+timing_middleware = hybrid_middleware(TimingMiddleware)
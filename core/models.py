@@ -1,5 +1,4 @@
 import json
-from dataclasses import dataclass, asdict
 from typing import Any, Dict, List, Union
 
 from django.core.exceptions import ObjectDoesNotExist
@@ -21,32 +20,48 @@ class JsonKey:
     timestamp = 'timestamp'
     messages = 'messages'
     buttons = 'buttons'
+    color = 'color'
+    # Clients that render the color themselves send markup = false
+    markup = 'markup'
 
     # Config keys
     language = 'language'
     config = 'config'
 
 
-@dataclass
 class Data:
-    text: str = ''
-    username: str = None
-    roomname: str = None
-    fromstamp: int = 0
-    timestamp: int = -1
-    messages: List = None
-    buttons: List = None
+    """ A message or request, from the JSON keys that are also fields
+        Other keys (e.g. backend_secret) are left out
+    """
+    __slots__ = ('text', 'username', 'roomname', 'fromstamp', 'timestamp',
+                 'messages', 'buttons', 'markup', 'language')
+
+    text: str
+    username: str
+    roomname: str
+    fromstamp: int
+    timestamp: int
+    messages: List
+    buttons: List
+    markup: bool
 
     # Config params
-    language: str = None
+    language: str
+
+    # The fields with their default
+    DEFAULTS = (('text', ''), ('username', None), ('roomname', None),
+                ('fromstamp', 0), ('timestamp', -1), ('messages', None),
+                ('buttons', None), ('markup', True), ('language', None))
 
     def __init__(self, data_dict: Dict[str, Union[str, int]]):
         if not data_dict:
+            for key, default in self.DEFAULTS:
+                setattr(self, key, default)
             return
-        allowed_keys = [key for key in dir(JsonKey) if not key.startswith('_')]
-        for key, value in data_dict.items():
-            if key in allowed_keys:
-                setattr(self, key, value)
+
+        get = data_dict.get
+        for key, default in self.DEFAULTS:
+            setattr(self, key, get(key, default))
         if self.timestamp == -1:
             self.timestamp = now_stamp()
 
@@ -56,12 +71,14 @@ class Data:
     def __setitem__(self, key, value):
         return setattr(self, key, value)
 
-    def config(self):
-        return {k: v for k, v in asdict(self).items()
-                if k in [JsonKey.language]}
+    def as_dict(self) -> Dict[str, Any]:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def config(self) -> Dict[str, Any]:
+        return {JsonKey.language: self.language}
 
     def __repr__(self):
-        return str(asdict(self))
+        return str(self.as_dict())
 
 
 class Profile(models.Model):
@@ -70,7 +87,8 @@ class Profile(models.Model):
 
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     sub_id = models.TextField(max_length=40, blank=False)
-    onesignal_id = models.TextField(max_length=40, blank=True)
+    onesignal_id = models.CharField(max_length=40, blank=True,
+                                    db_index=True)
     config_str = models.TextField()
 
     @property
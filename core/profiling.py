@@ -0,0 +1,127 @@
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import logging
+import os
+from pathlib import Path
+import random
+import re
+from typing import Optional
+
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+from django.urls import Resolver404, resolve
+
+from core.utils import HybridMiddleware, hybrid_middleware
+
+logger_app = logging.getLogger('app')
+
+# Requests with this header set to the backend secret are always profiled
+HEADER = 'X-Profile'
+# Only the views of these modules are profiled
+MODULES = ('api.views', 'demo.views')
+
+
+def _get_dir() -> Path:
+    base_dir = Path(os.path.dirname(__file__)).parents[0]
+    return base_dir / '_log' / 'profiles'
+
+
+def is_sampled() -> bool:
+    """ Whether to profile this request or task, according to PROFILE_RATE """
+    rate = settings.PROFILE_RATE
+    return rate > 0 and random.random() < rate
+
+
+def _file_name(name: str, username: str) -> str:
+    stamp = datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')
+    name = re.sub(r'[^\w-]+', '_', name).strip('_') or 'root'
+    username = re.sub(r'[^\w@.-]+', '_', username or 'anonymous')
+    return f'{stamp}.{name}.{username}.prof'
+
+
+def _write(profiler: cProfile.Profile, name: str, username: str):
+    os.makedirs(str(_get_dir()), exist_ok=True)
+    file_path = _get_dir() / _file_name(name, username)
+    profiler.dump_stats(str(file_path))
+    logger_app.info(f"Profile written to {file_path}",
+                    extra={'origin': 'PROFILING'})
+
+
+@contextmanager
+def profiled(name: str, username: str):
+    """ Profile the block and write the stats to _log/profiles/
+        Open with e.g. `python -m pstats <file>` or snakeviz
+
+        :param name: the endpoint or task name
+        :param username: the user the request or task is for
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _write(profiler, name, username)
+
+
+class ProfilingMiddleware(HybridMiddleware):
+    """ Profile sampled requests, and those with the profiling header
+        Costs a dict lookup per request when profiling is off
+
+        Under ASGI only the event loop thread is profiled : that includes
+        the other requests on the loop, but not the sync_to_async parts
+    """
+
+    def call(self, request: HttpRequest) -> HttpResponse:
+        profiler = self._start(request)
+        if profiler is None:
+            return self.get_response(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            profiler.disable()
+        self._write_profile(request, profiler)
+        return response
+
+    async def acall(self, request: HttpRequest) -> HttpResponse:
+        profiler = self._start(request)
+        if profiler is None:
+            return await self.get_response(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            profiler.disable()
+        self._write_profile(request, profiler)
+        return response
+
+    @staticmethod
+    def _start(request: HttpRequest) -> Optional[cProfile.Profile]:
+        requested = HEADER in request.headers and \
+            request.headers[HEADER] == settings.BACKEND_SECRET
+        if not requested and not is_sampled():
+            return None
+
+        # Resolved here as well, the view is only known after the middleware
+        try:
+            match = resolve(request.path_info)
+        except Resolver404 as _:
+            return None
+        if match.func.__module__ not in MODULES:
+            return None
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    @staticmethod
+    def _write_profile(request: HttpRequest, profiler: cProfile.Profile):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            username = user.username
+        else:
+            username = request.META.get('REMOTE_ADDR')
+        _write(profiler, request.resolver_match.route, username)
+
+
+profiling_middleware = hybrid_middleware(ProfilingMiddleware)
@@ -1,6 +1,10 @@
+import asyncio
+from contextlib import asynccontextmanager
 import json
 import logging
-from typing import Dict, Union
+from typing import Any, AsyncIterator, Dict, List, TYPE_CHECKING, Tuple, \
+    Union
+from weakref import WeakKeyDictionary
 
 import requests
 from background_task import background
@@ -10,12 +14,24 @@ from django.contrib.auth.models import User
 from api.notifications import send_notification
 from chat.models import ChatMessage
 from core.config import Config, Color, LANGUAGES
+from core.metrics import RASA, timed
 from core.models import Data, JsonKey
+from core.utils import in_db_thread
+
+if TYPE_CHECKING:
+    import httpx
 
 logger_app = logging.getLogger('app')
 
 HEADERS = {'Content-Type': 'application/json'}
 
+# Under ASGI the event loop lasts as long as the worker, its client is kept
+# for the requests that follow. Elsewhere a loop only lasts for one call
+# (async_to_sync under WSGI), so is the client
+_share_async_clients = False
+_async_clients: 'WeakKeyDictionary[Any, httpx.AsyncClient]' = \
+    WeakKeyDictionary()
+
 
 def _get_params(user: User, data: Data) -> Dict[str, Union[str, int]]:
     return {
@@ -24,42 +40,116 @@ def _get_params(user: User, data: Data) -> Dict[str, Union[str, int]]:
     }
 
 
-def converse_with_rasa(data: Data, add_ping: bool = True):
+def share_async_clients():
+    """ Keep a client per event loop, called by the ASGI entry point """
+    global _share_async_clients
+    _share_async_clients = True
+
+
+@asynccontextmanager
+async def _async_client() -> AsyncIterator['httpx.AsyncClient']:
+    # Only needed by the async views
+    import httpx
+
+    # No timeout, as with requests : a turn can take long
+    if not _share_async_clients:
+        async with httpx.AsyncClient(timeout=None) as client:
+            yield client
+        return
+
+    loop = asyncio.get_event_loop()
+    if loop not in _async_clients:
+        _async_clients[loop] = httpx.AsyncClient(timeout=None)
+    yield _async_clients[loop]
+
+
+def converse_with_rasa(data: Data, add_ping: bool = True) \
+        -> List[ChatMessage]:
     """ This sends a message to the Rasa bot
 
         :param data: the Data object from the user input
         :param add_ping: whether or not to add a ping for the web clients
+        :return: the stored replies of the bot
     """
 
     try:
         rasa_url = Config.get_rasa_url(data)
         payload = {'sender': data.username, 'message': data.text}
-        r = requests.post(rasa_url, json=payload)
-        response = json.loads(r.text)
-
-        for utterance in response:
-            new_data = Data({JsonKey.roomname: data.username,
-                             JsonKey.username: settings.CHAT_MASTER,
-                             JsonKey.text: utterance['text'],
-                             JsonKey.buttons: utterance.get('buttons', [])})
-            chat_message = ChatMessage.from_data(new_data, Color.OPTIONAL)
-            chat_message.save()
-        if response:
-            # Send notifications to device
-            send_notification(data.username, add_ping=add_ping)
+        with timed(RASA):
+            r = requests.post(rasa_url, json=payload)
+        return _save_replies(data, json.loads(r.text), add_ping)
 
     except Exception as e:
         logger_app.warning(e, extra={'origin': 'CONVERSE RASA'})
         logger_app.warning(data, extra={'origin': 'CONVERSE RASA'})
+        return []
 
 
-def set_rasa_names(user: User, data: Data):
+async def converse_with_rasa_async(data: Data, add_ping: bool = True) \
+        -> List[ChatMessage]:
+    """ converse_with_rasa for the async views, the event loop is free to
+        handle other requests while the bot replies
+
+        :param data: the Data object from the user input
+        :param add_ping: whether or not to add a ping for the web clients
+        :return: the stored replies of the bot
+    """
+
+    try:
+        rasa_url = Config.get_rasa_url(data)
+        payload = {'sender': data.username, 'message': data.text}
+        async with _async_client() as client:
+            with timed(RASA):
+                r = await client.post(rasa_url, json=payload)
+        return await in_db_thread(_save_replies)(
+            data, json.loads(r.text), add_ping)
+
+    except Exception as e:
+        logger_app.warning(e, extra={'origin': 'CONVERSE RASA'})
+        logger_app.warning(data, extra={'origin': 'CONVERSE RASA'})
+        return []
+
+
+def _save_replies(data: Data, response: List[Dict[str, Any]],
+                  add_ping: bool) -> List[ChatMessage]:
+    replies = []
+    for utterance in response:
+        new_data = Data({JsonKey.roomname: data.username,
+                         JsonKey.username: settings.CHAT_MASTER,
+                         JsonKey.text: utterance['text'],
+                         JsonKey.buttons: utterance.get('buttons', [])})
+        chat_message = ChatMessage.from_data(new_data, Color.OPTIONAL)
+        chat_message.save()
+        replies.append(chat_message)
+    if response:
+        # Send notifications to device
+        send_notification(data.username, add_ping=add_ping)
+    return replies
+
+
+def _get_names_request(user: User, data: Data) -> Tuple[str, str]:
     url = settings.RASA_API.format(**_get_params(user, data))
     payload = [{'event': 'slot', 'name': slot[0], 'value': slot[1]}
                for slot in (('first_name', user.first_name),
                             ('last_name', user.last_name),
                             ('full_name', user.profile.full_name))]
-    r = requests.post(url, data=json.dumps(payload), headers=HEADERS)
+    return url, json.dumps(payload)
+
+
+def set_rasa_names(user: User, data: Data):
+    url, content = _get_names_request(user, data)
+    with timed(RASA):
+        requests.post(url, data=content, headers=HEADERS)
+
+
+async def set_rasa_names_async(user: User, data: Data):
+    """ set_rasa_names for the async views
+        The profile of the user must be loaded already (select_related)
+    """
+    url, content = _get_names_request(user, data)
+    async with _async_client() as client:
+        with timed(RASA):
+            await client.post(url, content=content, headers=HEADERS)
 
 
 def get_button_texts(data: Data, username: str) -> Dict[str, str]:
@@ -67,7 +157,8 @@ def get_button_texts(data: Data, username: str) -> Dict[str, str]:
     url = Config.get_action_url(data)
     payload = {"next_action": "action_buttons", "tracker": {},
                "domain": {'institution': institution}}
-    r = requests.post(url, json=payload)
+    with timed(RASA):
+        r = requests.post(url, json=payload)
     results = json.loads(r.text)
     responses = results['responses']
     return responses[0]['custom']
@@ -38,6 +38,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.timing_middleware',
+    'core.memory.memory_middleware',
+    'core.users.users_middleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -46,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.profiling.profiling_middleware',
 ]
 
 REST_FRAMEWORK = {
@@ -105,11 +109,13 @@ LOGGING = {
         }
     },
 
+    # The files are opened when first written to, CoreConfig creates the dirs
     'handlers': {
         'app': {
             'level': 'INFO',
             'class': 'logging.FileHandler',
             'filename': './_log/app.log',
+            'delay': True,
             'formatter': 'default'
         },
 
@@ -117,12 +123,14 @@ LOGGING = {
             'level': 'DEBUG',
             'class': 'logging.FileHandler',
             'filename': './_log/debug.log',
+            'delay': True,
             'formatter': 'default'
         },
         # Not actual loggers, only used for the file locations
         'chat': {
             'class': 'logging.FileHandler',
             'filename': './_log/chat/default.log',
+            'delay': True,
         },
     },
     'loggers': {
@@ -140,8 +148,6 @@ LOGGING = {
     },
 }
 
-os.makedirs('./_log/chat/', exist_ok=True)
-
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -216,13 +222,42 @@ CORS_ORIGIN_ALLOW_ALL = True
 CORS_ALLOW_HEADERS = list(default_headers) + ['Access-Token', ]
 
 TASKS_CSV = 'tasks.csv'
+# Task runner reloads the upcoming tasks from the DB every minute
+TASKS_REFRESH = 60
+# Tasks for different users run concurrently, in 'thread' or 'process' pool
+TASKS_WORKERS = 4
+TASKS_POOL = 'thread'
+
+# Fraction (0 to 1) of the requests and tasks to profile to _log/profiles/
+# Single requests are profiled with the header X-Profile: <BACKEND_SECRET>
+PROFILE_RATE = float(os.getenv('PROFILE_RATE', 0))
+# Log the peak allocation, RSS delta and top allocation sites of each
+# request and management command (slow, for finding memory hot spots)
+MEMORY_TRACKING = bool(os.getenv('MEMORY_TRACKING'))
 
 # Chat settings
 CHAT_MASTER = 'bot'
 CHAT_MASTER_NAME = '<TODO>'
+# Messages older than 90 days move to the archive table, once a day,
+# in chunks of 1000 messages per transaction
+ARCHIVE_AGE = 90 * 24 * 60 * 60
+ARCHIVE_REPEAT = 24 * 60 * 60
+ARCHIVE_CHUNK = 1000
+# Idempotency keys of the ingress requests are kept for a day, expired keys
+# are removed every hour
+INGRESS_KEY_TTL = 24 * 60 * 60
+INGRESS_KEY_REPEAT = 60 * 60
 RASA_URL = 'http://localhost:{port}/webhooks/rest/webhook'
 RASA_API = 'http://localhost:{port}/conversations/{username}/tracker/events'
 ACTION_URL = 'http://localhost:{port}/webhook'
+# Pacing of fan-outs per Rasa bot : start `burst` conversations right away,
+# then at most `rate` per second. The task runner starts at most
+# `concurrency` of them at the same time, whatever fan-out they belong to
+RASA_PACING = {
+    'rate': 1,
+    'burst': 10,
+    'concurrency': 4,
+}
 
 # OneSignal
 USER_AUTH_KEY = '<TODO>'
@@ -0,0 +1,151 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+import copy
+import threading
+import time
+from typing import Dict, Iterator, Optional, Tuple
+
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpRequest, HttpResponse
+
+from core.models import Profile
+from core.utils import HybridMiddleware, hybrid_middleware
+
+# Seconds a user is kept in the process cache
+# Other processes don't see the signals, their changes show up after this
+TTL = 60
+# Number of users kept in the process cache, the least recently used go
+MAX_CACHED = 1000
+
+# The users looked up during the current request or task, None outside
+_memo: ContextVar[Optional[Dict[str, Optional[User]]]] = \
+    ContextVar('users', default=None)
+# Whether the current request or task may use the process cache
+_use_cache: ContextVar[bool] = ContextVar('use_cache', default=True)
+
+# {username: (expiry, user)}, shared by the threads of this process
+_cache: 'OrderedDict[str, Tuple[float, User]]' = OrderedDict()
+# {user id: username}, to invalidate on a change of the profile
+_usernames: Dict[int, str] = {}
+_lock = threading.Lock()
+
+
+def get_user(username: str) -> Optional[User]:
+    """ Get a user, with its profile, by username
+        From the current request or task if it was looked up before, else
+        from the process cache (unless memoized without it), else from the
+        DB in one query
+
+        The user of the process cache is a copy, it can be changed freely
+        Save the profile with update_fields, the cached copy might be stale
+
+        :param username: the username
+        :return: the user, or None if it doesn't exist
+    """
+    memo = _memo.get()
+    if memo is not None and username in memo:
+        return memo[username]
+
+    user = _get_cached(username) if _use_cache.get() else None
+    if user is None:
+        user = User.objects.select_related('profile') \
+            .filter(username=username).first()
+        if user is not None:
+            _set_cached(user)
+    if memo is not None:
+        memo[username] = user
+    return user
+
+
+def _get_cached(username: str) -> Optional[User]:
+    with _lock:
+        expiry, user = _cache.get(username, (0, None))
+        if user is None:
+            return None
+        if expiry < time.monotonic():
+            _remove(username)
+            return None
+        _cache.move_to_end(username)
+    return copy.deepcopy(user)
+
+
+def _set_cached(user: User):
+    user = copy.deepcopy(user)
+    with _lock:
+        _cache[user.username] = (time.monotonic() + TTL, user)
+        _cache.move_to_end(user.username)
+        _usernames[user.id] = user.username
+        while len(_cache) > MAX_CACHED:
+            username, (_, oldest) = _cache.popitem(last=False)
+            _usernames.pop(oldest.id, None)
+
+
+def _remove(username: str):
+    _, user = _cache.pop(username, (0, None))
+    if user is not None:
+        _usernames.pop(user.id, None)
+
+
+def invalidate(user_id: int):
+    """ Remove a user from the process cache, e.g. after a bulk update
+
+        :param user_id: the id of the user
+    """
+    with _lock:
+        username = _usernames.get(user_id)
+        if username is not None:
+            _remove(username)
+
+
+def clear():
+    """ Empty the process cache, e.g. after a bulk update of the profiles """
+    with _lock:
+        _cache.clear()
+        _usernames.clear()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def _invalidate_user(sender, instance: User, **kwargs):
+    invalidate(instance.id)
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def _invalidate_profile(sender, instance: Profile, **kwargs):
+    invalidate(instance.user_id)
+
+
+@contextmanager
+def memoized(process_cache: bool = True) -> Iterator[None]:
+    """ Look up each user once in the block, e.g. a request or task
+
+        :param process_cache: also use the process cache, which can be up to
+            TTL seconds behind the changes of other processes. Off for
+            tasks, that act on the config and OneSignal id
+    """
+    memo_token = _memo.set({})
+    cache_token = _use_cache.set(process_cache)
+    try:
+        yield
+    finally:
+        _use_cache.reset(cache_token)
+        _memo.reset(memo_token)
+
+
+class UsersMiddleware(HybridMiddleware):
+    """ Look up each user once per request """
+
+    def call(self, request: HttpRequest) -> HttpResponse:
+        with memoized():
+            return self.get_response(request)
+
+    async def acall(self, request: HttpRequest) -> HttpResponse:
+        with memoized():
+            return await self.get_response(request)
+
+
+users_middleware = hybrid_middleware(UsersMiddleware)
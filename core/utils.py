@@ -1,11 +1,14 @@
+from abc import ABC, abstractmethod
+import asyncio
 import time
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, Union
+from typing import Any, Callable, Dict, Type, Union
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.contrib.auth.models import User
 from django.core.mail import send_mail
+from django.utils.decorators import sync_and_async_middleware
 from pytz import timezone
 
 DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
@@ -33,6 +36,50 @@ def now_stamp() -> int:
     return int(time.time() * 1000)
 
 
+def in_db_thread(function: Callable) -> Callable:
+    """ Make a sync function that uses the DB awaitable from async code
+        All of them run in one thread, which owns the DB connection,
+        so Django can close it at the end of the request
+
+        :param function: the sync function
+        :return: the async function
+    """
+    return sync_to_async(function, thread_sensitive=True)
+
+
+class HybridMiddleware(ABC):
+    """ Base for middleware that runs sync under WSGI and async under ASGI,
+        without Django switching threads around it
+        Added to MIDDLEWARE via hybrid_middleware
+    """
+
+    def __init__(self, get_response: Callable):
+        self.get_response = get_response
+
+    @abstractmethod
+    def call(self, request):
+        """ Handle the request under WSGI """
+
+    @abstractmethod
+    async def acall(self, request):
+        """ Handle the request under ASGI """
+
+
+def hybrid_middleware(middleware_class: Type[HybridMiddleware]) -> Callable:
+    """ Make a middleware factory of the class, for MIDDLEWARE
+        Gives Django the coroutine function acall if the rest of the chain
+        is async, call otherwise
+    """
+    @sync_and_async_middleware
+    def middleware(get_response: Callable) -> Callable:
+        instance = middleware_class(get_response)
+        if asyncio.iscoroutinefunction(get_response):
+            return instance.acall
+        return instance.call
+
+    return middleware
+
+
 def is_extra_process(name: str) -> bool:
     """ Determine if this is not the main process, used in AppConfigs
         For Gunicorn : check via lock file
@@ -42,6 +89,10 @@ def is_extra_process(name: str) -> bool:
     """
 
     import os
+    # Gunicorn with core/gunicorn.py loads the app once, before forking
+    if os.environ.get('GUNICORN_PRELOAD'):
+        return False
+
     # Gunicorn doesn't use RUN_MAIN
     is_devserver = os.environ.get('SERVER_SOFTWARE') is None
 
@@ -74,10 +125,11 @@ def log_chat(data: Union['Data', 'ChatMessage', Dict[str, Any]]):
     """
 
     from chat.models import ChatMessage
+    from core.metrics import FILE, timed
     from core.models import Data, JsonKey
 
     if type(data) == Data:
-        chat_dict = data.__dict__
+        chat_dict = data.as_dict()
     elif type(data) == ChatMessage:
         chat_dict = data.as_dict
     else:
@@ -95,7 +147,7 @@ def log_chat(data: Union['Data', 'ChatMessage', Dict[str, Any]]):
         file_path = file_path.replace('default.log', f'{roomname}.log')
         file_path = file_path.replace(' ', '_')
 
-    with open(file_path, 'a') as f:
+    with timed(FILE), open(file_path, 'a') as f:
         for line in chat_dict[JsonKey.text].split("\n"):
             f.write("[{0}] [{1:<{2}}] {3}\n".format(
                 date_str, username, len(roomname), line))
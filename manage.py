@@ -14,7 +14,19 @@ def main():
             "available on your PYTHONPATH environment variable? Did you "
             "forget to activate a virtual environment?"
         ) from exc
-    execute_from_command_line(sys.argv)
+
+    # Read from the environment, the settings may still be switched by
+    # the --settings option
+    if os.getenv('MEMORY_TRACKING') and len(sys.argv) > 1:
+        from core.memory import tracked
+        # Also when the command exits, e.g. with an error
+        try:
+            with tracked(f'command {sys.argv[1]}') as measurement:
+                execute_from_command_line(sys.argv)
+        finally:
+            sys.stderr.write(measurement.report() + '\n')
+    else:
+        execute_from_command_line(sys.argv)
 
 
 if __name__ == '__main__':
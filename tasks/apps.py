@@ -3,3 +3,11 @@ from django.apps import AppConfig
 
 class TasksConfig(AppConfig):
     name = 'tasks'
+
+    def ready(self):
+        from background_task.models import Task
+        from django.db.models.signals import post_save
+
+        # Wake up the task runner when a task is stored
+        from tasks.scheduler import task_saved
+        post_save.connect(task_saved, sender=Task)
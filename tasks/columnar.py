@@ -0,0 +1,161 @@
+""" Compressed, chunked, columnar file format for the exported conversations
+
+    Layout :
+        MAGIC
+        chunk*  : the rows of one room, per column a 4 byte length and the
+                  zlib compressed values (date : int64 ms, others : JSON)
+        index   : zlib compressed JSON with the columns and per room the
+                  chunks as [offset, length, rows, first date, last date]
+        trailer : 8 byte offset of the index, MAGIC
+
+    A room or time range can be read without decompressing the other chunks.
+"""
+from array import array
+import json
+import struct
+import sys
+from typing import Any, BinaryIO, Dict, Iterator, List, Tuple
+import zlib
+
+MAGIC = b'GSCOL01\n'
+COLUMNS = ('date', 'user', 'style', 'data', 'text', 'room')
+# Maximum number of rows per chunk
+CHUNK_ROWS = 5000
+
+Row = Tuple[int, str, str, str, str, str]
+
+
+def _dates_to_bytes(dates: List[int]) -> bytes:
+    values = array('q', dates)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _bytes_to_dates(data: bytes) -> List[int]:
+    values = array('q')
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tolist()
+
+
+class ColumnarWriter:
+    """ Write the rows room by room, as they come from the export """
+
+    def __init__(self, file_name: str, chunk_rows: int = CHUNK_ROWS):
+        self.chunk_rows = chunk_rows
+        self._f: BinaryIO = open(file_name, 'wb')
+        self._f.write(MAGIC)
+        self._rows: List[Row] = []
+        self._index: Dict[str, List[List[int]]] = {}
+
+    def add(self, date: int, user: str, style: str, data: str, text: str,
+            room: str):
+        """ Add a row, the rows of a room should be added in date order """
+        if self._rows and (self._rows[-1][5] != room or
+                           len(self._rows) >= self.chunk_rows):
+            self._flush()
+        self._rows.append((date, user, style, data, text, room))
+
+    def _flush(self):
+        columns = list(zip(*self._rows))
+        offset = self._f.tell()
+        for i, values in enumerate(columns):
+            if COLUMNS[i] == 'date':
+                data = _dates_to_bytes(list(values))
+            else:
+                data = json.dumps(values).encode()
+            data = zlib.compress(data)
+            self._f.write(struct.pack('<I', len(data)))
+            self._f.write(data)
+
+        room = self._rows[0][5]
+        self._index.setdefault(room, []).append(
+            [offset, self._f.tell() - offset, len(self._rows),
+             self._rows[0][0], self._rows[-1][0]])
+        self._rows = []
+
+    def close(self):
+        if self._rows:
+            self._flush()
+        offset = self._f.tell()
+        index = {'columns': COLUMNS, 'rooms': self._index}
+        self._f.write(zlib.compress(json.dumps(index).encode()))
+        self._f.write(struct.pack('<Q', offset))
+        self._f.write(MAGIC)
+        self._f.close()
+
+    def __enter__(self) -> 'ColumnarWriter':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ColumnarReader:
+    """ Read (parts of) a file written by the ColumnarWriter
+
+        with ColumnarReader('conversations.col') as reader:
+            for row in reader.read_room('123456ab@eur.nl'):
+                ...
+    """
+
+    def __init__(self, file_name: str):
+        self._f: BinaryIO = open(file_name, 'rb')
+        if self._f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"Not a conversations file : '{file_name}'")
+        self._f.seek(-(8 + len(MAGIC)), 2)
+        index_end = self._f.tell()
+        offset = struct.unpack('<Q', self._f.read(8))[0]
+        self._f.seek(offset)
+        index = json.loads(zlib.decompress(self._f.read(index_end - offset)))
+        self._index: Dict[str, List[List[int]]] = index['rooms']
+
+    @property
+    def rooms(self) -> List[str]:
+        return list(self._index.keys())
+
+    def _read_chunk(self, offset: int, length: int) -> Iterator[Row]:
+        self._f.seek(offset)
+        data = self._f.read(length)
+        columns: List[Any] = []
+        position = 0
+        for name in COLUMNS:
+            size = struct.unpack_from('<I', data, position)[0]
+            position += 4
+            values = zlib.decompress(data[position:position + size])
+            position += size
+            if name == 'date':
+                columns.append(_bytes_to_dates(values))
+            else:
+                columns.append(json.loads(values))
+        return zip(*columns)
+
+    def read_room(self, room: str, start: int = None,
+                  end: int = None) -> Iterator[Row]:
+        """ Get the rows of a room, optionally only those from start to
+            end (timestamps in ms, inclusive)
+        """
+        for offset, length, _, first, last in self._index.get(room, []):
+            if (start is not None and last < start) or \
+                    (end is not None and first > end):
+                continue
+            for row in self._read_chunk(offset, length):
+                if (start is None or row[0] >= start) and \
+                        (end is None or row[0] <= end):
+                    yield row
+
+    def read_range(self, start: int = None, end: int = None) -> Iterator[Row]:
+        """ Get the rows of all rooms from start to end, room by room """
+        for room in self.rooms:
+            yield from self.read_room(room, start, end)
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self) -> 'ColumnarReader':
+        return self
+
+    def __exit__(self, *args):
+        self.close()
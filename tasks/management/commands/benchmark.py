@@ -0,0 +1,180 @@
+from dataclasses import asdict, dataclass
+import json
+import os
+import subprocess
+import sys
+import timeit
+from typing import Callable, Dict, List, Tuple, Union
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Data, JsonKey
+from core.utils import now_stamp
+
+# A sync request as sent by the app, with keys Data leaves out
+REQUEST = {
+    JsonKey.text: 'Hello', JsonKey.username: 'user@eur.nl',
+    JsonKey.roomname: 'user@eur.nl', JsonKey.fromstamp: 1600000000000,
+    JsonKey.language: 'EN', 'backend_secret': '-', 'institution': 'EUR',
+}
+# A reply of the Rasa bot
+UTTERANCE = {
+    JsonKey.roomname: 'user@eur.nl', JsonKey.username: 'bot',
+    JsonKey.text: 'How are you?', JsonKey.buttons: [],
+}
+
+DATA = 'data'
+STARTUP = 'startup'
+# What a fresh worker does before its first request, run in a new process
+STARTUP_CODE = '''
+import json, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+from django.urls import get_resolver
+get_resolver().url_patterns
+print(json.dumps({'seconds': time.perf_counter() - start,
+                  'loaded': [m for m in %r if m in sys.modules]}))
+'''
+# Only needed by some processes, should not be loaded at startup
+LAZY_MODULES = ('onesignal', 'lxml', 'httpx')
+
+
+@dataclass
+class ReferenceData:
+    """ Data as it was before it used slots, to compare against """
+    text: str = ''
+    username: str = None
+    roomname: str = None
+    fromstamp: int = 0
+    timestamp: int = -1
+    messages: List = None
+    buttons: List = None
+    markup: bool = True
+    language: str = None
+
+    def __init__(self, data_dict: Dict[str, Union[str, int]]):
+        if not data_dict:
+            return
+        allowed_keys = [key for key in dir(JsonKey) if not key.startswith('_')]
+        for key, value in data_dict.items():
+            if key in allowed_keys:
+                setattr(self, key, value)
+        if self.timestamp == -1:
+            self.timestamp = now_stamp()
+
+    def config(self):
+        return {k: v for k, v in asdict(self).items()
+                if k in [JsonKey.language]}
+
+
+def per_call(function: Callable, number: int) -> float:
+    """ Microseconds per call, best of 5 runs """
+    return min(timeit.repeat(function, number=number, repeat=5)) \
+        / number * 1e6
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmarks of the code run for every request, ' \
+           'and of the startup of a worker'
+
+    def handle(self, **options):
+        benchmarks = options['benchmarks'] or [DATA, STARTUP]
+        unknown = set(benchmarks) - {DATA, STARTUP}
+        if unknown:
+            raise CommandError(f"Unknown benchmarks {', '.join(unknown)}, "
+                               f"choose from {DATA}, {STARTUP}")
+        if DATA in benchmarks:
+            self.print_data(self.benchmark_data(options['number']))
+        if STARTUP in benchmarks:
+            seconds, loaded, imports = self.benchmark_startup()
+            self.print_startup(seconds, loaded, imports)
+            max_startup = options['max_startup']
+            if loaded or (max_startup and seconds * 1000 > max_startup):
+                sys.exit(1)
+
+    def add_arguments(self, parser):
+        # Checked in handle : argparse checks an empty list against choices
+        parser.add_argument('benchmarks', nargs='*',
+                            help=f"The benchmarks to run, {DATA} and/or "
+                                 f"{STARTUP}, default all")
+        parser.add_argument('-n', '--number', type=int, default=20000,
+                            help="Number of calls per run")
+        parser.add_argument('-m', '--max-startup', type=float,
+                            help="Fail if the startup takes longer (ms)")
+
+    @staticmethod
+    def print_data(results: List[Tuple[str, float, float]]):
+        print()
+        print(f"{'BENCHMARK':<32} {'BEFORE µs':>10} {'NOW µs':>10} "
+              f"{'SPEED-UP':>9}")
+        for name, before, now in results:
+            print(f'{name:<32} {before:>10.2f} {now:>10.2f} '
+                  f'{before / now:>8.1f}x')
+        print()
+
+    @staticmethod
+    def print_startup(seconds: float, loaded: List[str],
+                      imports: List[Tuple[str, int]]):
+        print()
+        print(f'Startup         : {seconds * 1000:.0f} ms')
+        print(f"Loaded too soon : {', '.join(loaded) or '-'}")
+        print()
+        print(f"{'SLOWEST IMPORTS':<32} {'ms':>10}")
+        for name, microseconds in imports[:10]:
+            print(f'{name:<32} {microseconds / 1000:>10.1f}')
+        print()
+
+    @staticmethod
+    def benchmark_startup() -> Tuple[float, List[str], List[Tuple[str, int]]]:
+        """ Load the app in a new process, as a worker does
+
+            :return: the seconds it took, the LAZY_MODULES that were loaded
+                and the top level imports with their cumulative microseconds
+        """
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [settings.BASE_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime',
+             '-c', STARTUP_CODE % (LAZY_MODULES,)],
+            env=env, capture_output=True, text=True, check=True)
+        info = json.loads(result.stdout.splitlines()[-1])
+
+        # Lines of 'import time: self | cumulative | name', nested imports
+        # are indented
+        imports = []
+        for line in result.stderr.splitlines():
+            parts = line.split('|')
+            if len(parts) != 3 or not parts[1].strip().isdigit():
+                continue
+            name = parts[2][1:]
+            if not name.startswith(' '):
+                imports.append((name, int(parts[1])))
+        imports.sort(key=lambda item: item[1], reverse=True)
+        return info['seconds'], info['loaded'], imports
+
+    @staticmethod
+    def benchmark_data(number: int) -> List[Tuple[str, float, float]]:
+        # A sync builds Data for the request and one per Rasa utterance,
+        # and gets its config at least once
+        def request(data_class):
+            data = data_class(REQUEST)
+            data.config()
+            data_class(UTTERANCE)
+            data_class(UTTERANCE)
+
+        reference, data = ReferenceData(REQUEST), Data(REQUEST)
+        return [
+            (name, per_call(before, number), per_call(now, number))
+            for name, before, now in (
+                ('Data from request', lambda: ReferenceData(REQUEST),
+                 lambda: Data(REQUEST)),
+                ('Data from utterance', lambda: ReferenceData(UTTERANCE),
+                 lambda: Data(UTTERANCE)),
+                ('Data.config', reference.config, data.config),
+                ('Data per sync request', lambda: request(ReferenceData),
+                 lambda: request(Data)),
+            )
+        ]
@@ -0,0 +1,108 @@
+import json
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import QuerySet
+
+from chat.models import ArchivedChatMessage, BaseChatMessage, ButtonSet, \
+    ChatMessage
+from core.config import Color
+
+# Number of messages read and updated per transaction
+BATCH_SIZE = 1000
+# A plain text wrapped in a color, as stored by ChatMessage.from_data before
+SPAN = re.compile(r"""^<span style=(['"])color: ?([\w-]+);?\1>([^<]*)</span>$""")
+COLORS: Dict[str, int] = {color.value: color.index for color in Color}
+
+
+def get_text_color(text: str) -> Optional[Tuple[str, int]]:
+    """ Split a text wrapped in a known color into the plain text and the
+        index of the color, None if it's anything else
+    """
+    match = SPAN.match(text)
+    if not match or match.group(2) not in COLORS:
+        return None
+    return match.group(3), COLORS[match.group(2)]
+
+
+def compact_color(batch: List[BaseChatMessage]) -> List[BaseChatMessage]:
+    changed = []
+    for message in batch:
+        text_color = get_text_color(message.text)
+        if text_color:
+            message.text, message.color = text_color
+            changed.append(message)
+    return changed
+
+
+def compact_buttons(batch: List[BaseChatMessage]) -> List[BaseChatMessage]:
+    # Sets are only cached once committed, intern each list once per batch
+    set_ids: Dict[str, Optional[int]] = {}
+    changed = []
+    for message in batch:
+        try:
+            buttons = json.loads(message.buttons_str)
+        except ValueError as _:
+            continue
+        key = json.dumps(buttons, sort_keys=True)
+        if key not in set_ids:
+            set_ids[key] = ButtonSet.intern(buttons)
+        message.button_set_id = set_ids[key]
+        message.buttons_str = ''
+        changed.append(message)
+    return changed
+
+
+class Command(BaseCommand):
+    help = 'Move the color markup of the stored messages to the color ' \
+           'column, and their buttons to shared button sets'
+
+    def handle(self, **options):
+        print()
+        for model in (ChatMessage, ArchivedChatMessage):
+            colors = self.compact_messages(
+                model.objects.filter(color=None,
+                                     text__startswith='<span style='),
+                ['text', 'color'], compact_color, options['batch'])
+            buttons = self.compact_messages(
+                model.objects.filter(button_set=None).exclude(buttons_str=''),
+                ['buttons_str', 'button_set'], compact_buttons,
+                options['batch'])
+            print(f'{model.__name__:<20}: {colors} colors, '
+                  f'{buttons} button lists compacted')
+        print()
+
+    def add_arguments(self, parser):
+        parser.add_argument('-b', '--batch', type=int, default=BATCH_SIZE,
+                            help="Number of messages per transaction")
+
+    @staticmethod
+    def compact_messages(messages: QuerySet, fields: List[str],
+                         compact: Callable[[List[BaseChatMessage]],
+                                           List[BaseChatMessage]],
+                         batch_size: int = BATCH_SIZE) -> int:
+        """ Convert the messages a batch at a time
+            Can be interrupted and run again, converted messages are skipped
+
+            :param messages: the messages that might need converting
+            :param fields: the fields that are converted
+            :param compact: converts a batch, returns the converted messages
+            :param batch_size: number of messages per transaction
+            :return: the number of converted messages
+        """
+        messages = messages.order_by('id').only('id', *fields)
+        count = 0
+        last_id = 0
+        while True:
+            with transaction.atomic():
+                batch = list(messages.filter(id__gt=last_id)[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                changed = compact(batch)
+                messages.model.objects.bulk_update(changed, fields)
+            count += len(changed)
+        return count
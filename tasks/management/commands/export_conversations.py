@@ -1,61 +1,303 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 import csv
 from datetime import datetime
-from typing import List, Tuple
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple, \
+    Type
 from lxml import etree
 
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max, Q
 
-from chat.models import ChatMessage
+from chat.models import ArchivedChatMessage, BaseChatMessage, ChatMessage
+from core.config import Color
+from tasks.columnar import ColumnarWriter
+
+# Number of messages fetched per query, and parsed per worker job
+CHUNK_SIZE = 2000
+# What the last export got to, for incremental exports
+STATE_FILE = 'conversations.state.json'
+
+MessageRow = Tuple[int, str, str, str, int, Optional[int]]
+
+
+def parse_texts(texts: List[str]) -> List[Tuple[str, str, str]]:
+    """ Parse a chunk of message texts, used by the worker processes """
+    return [Command.get_text_data_style(text) for text in texts]
 
 
 class Command(BaseCommand):
     help = 'Export the Chat conversations, one TSV file per user'
 
     def handle(self, **options):
-        self.export_conversations()
-
-    def export_conversations(self):
-        conversation_dict = {}
-        for user in sorted(User.objects.all(), key=lambda u: u.username):
-            conversation_dict[user.username] = self.get_conversations(user)
-
-        for username, conversations in conversation_dict.items():
-            if not conversations:
-                continue
-
-            file_name = f'conversations.{username}.tsv'.replace(' ', '_')
-            with open(file_name, 'w') as f:
-                writer = csv.writer(f, delimiter='\t',
-                                    quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                writer.writerow(['DATE', 'USER', 'STYLE', 'DATA', 'TEXT'])
-                for conversation in conversations:
-                    writer.writerow(conversation)
-
-    def get_conversations(self, user: User) -> List[List[str]]:
-        conversations = []
-        for message in ChatMessage.objects.filter(roomname=user.username):
-            date = datetime.fromtimestamp(message.timestamp / 1000)
+        self.export_conversations(options['jobs'], options['incremental'],
+                                  options['columnar'])
+
+    def add_arguments(self, parser):
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help="Number of processes parsing the messages")
+        parser.add_argument('-i', '--incremental', action='store_true',
+                            help="Only append the messages that are new "
+                                 "since the last export")
+        parser.add_argument('-c', '--columnar', type=str,
+                            help="Also write the exported messages to this "
+                                 "compressed, columnar file")
+
+    def export_conversations(self, jobs: int = 1, incremental: bool = False,
+                             columnar: str = None):
+        state = self.read_state() if incremental else {}
+        with self.snapshot():
+            self.export_messages(state, jobs, incremental, columnar)
+
+    def export_messages(self, state: Dict[str, Any], jobs: int,
+                        incremental: bool, columnar: Optional[str]):
+        sizes = state.get('rooms', {})
+        # Messages stored during the export are left for the next one
+        last_id = self.get_last_id()
+        condition = Q(id__lte=last_id)
+        if incremental:
+            condition &= self.get_new_condition(state)
+
+        # The messages come in per room, switch files on room boundaries
+        # A room comes in twice if it has archived messages : append then
+        changes = {}
+        roomname = None
+        f = None
+        columnar_writer = ColumnarWriter(columnar) if columnar else None
+        try:
+            for message, conversation in self.get_conversations(jobs,
+                                                                condition):
+                if message[1] != roomname:
+                    if f:
+                        f.close()
+                    roomname = message[1]
+                    if roomname in changes:
+                        size = os.path.getsize(self.get_file_name(roomname))
+                    else:
+                        size = sizes.get(roomname)
+                    f = self.open_file(roomname, size)
+                    writer = csv.writer(f, delimiter='\t', quotechar='"',
+                                        quoting=csv.QUOTE_MINIMAL)
+                    if size is None:
+                        writer.writerow(
+                            ['DATE', 'USER', 'STYLE', 'DATA', 'TEXT'])
+                writer.writerow(conversation)
+                if columnar_writer:
+                    columnar_writer.add(message[4], *conversation[1:],
+                                        roomname)
+
+                changes[roomname] = changes.get(roomname, 0) + 1
+        finally:
+            if f:
+                f.close()
+            if columnar_writer:
+                columnar_writer.close()
+
+        for roomname in changes:
+            sizes[roomname] = os.path.getsize(self.get_file_name(roomname))
+        state['rooms'] = sizes
+        state['last_id'] = last_id
+        self.write_state(state)
+        self.report(changes)
+
+    @staticmethod
+    @contextmanager
+    def snapshot() -> Iterator[None]:
+        """ Read all messages as of the start of the export
+            archive_messages moves messages to the archive meanwhile : one
+            moved after the archive was read would be in neither table
+        """
+        with transaction.atomic():
+            if connection.vendor == 'mysql':
+                # Django reads with READ COMMITTED, each query sees the
+                # latest rows. Here the first read takes the snapshot
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            yield
+
+    @staticmethod
+    def get_file_name(roomname: str) -> str:
+        return f'conversations.{roomname}.tsv'.replace(' ', '_')
+
+    @classmethod
+    def open_file(cls, roomname: str, size: int = None) -> TextIO:
+        """ Open the file of a room, to append from `size` on if given
+            What an interrupted export wrote after that is removed
+        """
+        if size is None:
+            return open(cls.get_file_name(roomname), 'w')
+        f = open(cls.get_file_name(roomname), 'a')
+        if f.tell() > size:
+            f.truncate(size)
+        return f
+
+    @classmethod
+    def read_state(cls) -> Dict[str, Any]:
+        """ Get what the last export got to : all messages up to last_id
+            are exported, the rooms are the sizes of the files after it
+            Rooms of which the file is gone are exported from the start
+        """
+        try:
+            with open(STATE_FILE, 'r') as f:
+                state = json.loads(f.read() or '{}')
+        except FileNotFoundError as _:
+            return {}
+
+        rooms = state.get('rooms', {})
+        for roomname in list(rooms.keys()):
+            if not os.path.isfile(cls.get_file_name(roomname)):
+                del rooms[roomname]
+        return state
+
+    @staticmethod
+    def write_state(state: Dict[str, Any]):
+        # Write and rename, an interrupted export keeps the old state
+        # The next one then truncates the files back to their old sizes
+        with open(f'{STATE_FILE}.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(f'{STATE_FILE}.tmp', STATE_FILE)
+
+    @staticmethod
+    def get_last_id() -> int:
+        """ The highest id of the messages, archived ones keep their id """
+        return max(model.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+                   for model in (ArchivedChatMessage, ChatMessage))
+
+    @staticmethod
+    def get_new_condition(state: Dict[str, Any]) -> Q:
+        """ Messages stored since the last export have a higher id,
+            whatever their timestamp
+            Rooms that weren't exported yet need all their messages
+        """
+        usernames = set(User.objects.values_list('username', flat=True))
+        new_rooms = usernames - set(state.get('rooms', {}).keys())
+        return Q(id__gt=state.get('last_id', 0)) | Q(roomname__in=new_rooms)
+
+    @staticmethod
+    def report(changes: Dict[str, int]):
+        print()
+        for roomname, count in sorted(changes.items()):
+            print(f'{roomname:<40}: {count} messages')
+        print(f'Exported {sum(changes.values())} messages '
+              f'in {len(changes)} conversations')
+        print()
+
+    def get_conversations(self, jobs: int, condition: Q = None) \
+            -> Iterator[Tuple[MessageRow, List[str]]]:
+        """ Get the messages with their TSV rows, in order
+            Messages with markup are parsed by a pool of `jobs` processes,
+            with a few chunks in flight to keep the memory use bounded
+        """
+        if jobs <= 1:
+            for chunk in self.stream_messages(condition):
+                yield from self.get_chunk_conversations(
+                    chunk, parse_texts([message[3] for message in chunk]))
+            return
+
+        with ProcessPoolExecutor(jobs) as pool:
+            pending = deque()
+            for chunk in self.stream_messages(condition):
+                # Only the messages with markup need to go to the pool
+                markup = [message[3] for message in chunk if '<' in message[3]]
+                pending.append((chunk, pool.submit(parse_texts, markup)))
+                if len(pending) >= 2 * jobs:
+                    chunk, future = pending.popleft()
+                    yield from self.get_chunk_conversations(
+                        chunk, self.merge_parsed(chunk, future.result()))
+            while pending:
+                chunk, future = pending.popleft()
+                yield from self.get_chunk_conversations(
+                    chunk, self.merge_parsed(chunk, future.result()))
+
+    @staticmethod
+    def merge_parsed(chunk: List[MessageRow],
+                     parsed_markup: List[Tuple[str, str, str]]) \
+            -> List[Tuple[str, str, str]]:
+        """ Combine the parsed markup messages with the plain messages,
+            which are handled here by the fast path
+        """
+        parsed = iter(parsed_markup)
+        return [next(parsed) if '<' in message[3]
+                else Command.get_text_data_style(message[3])
+                for message in chunk]
+
+    @classmethod
+    def stream_messages(cls, condition: Q = None,
+                        chunk_size: int = CHUNK_SIZE) \
+            -> Iterator[List[MessageRow]]:
+        """ Get the messages of all users, first the archived ones then the
+            recent ones, each ordered by room and time
+            The archived messages of a room are older than its recent ones
+
+            :param condition: optionally only get these messages
+            :param chunk_size: number of messages per query
+            :return: chunks of (id, roomname, username, text, timestamp, color)
+        """
+        for model in (ArchivedChatMessage, ChatMessage):
+            yield from cls.stream_model_messages(model, condition, chunk_size)
+
+    @staticmethod
+    def stream_model_messages(model: Type[BaseChatMessage],
+                              condition: Q = None,
+                              chunk_size: int = CHUNK_SIZE) \
+            -> Iterator[List[MessageRow]]:
+        """ Get the messages of all users from one table, by room and time
+            Uses keyset pagination, so only one chunk is in memory at a time
+            and every query continues via the (roomname, timestamp) index
+        """
+        messages = model.objects \
+            .filter(roomname__in=User.objects.values('username')) \
+            .order_by('roomname', 'timestamp', 'id')
+        if condition is not None:
+            messages = messages.filter(condition)
+        fields = ('id', 'roomname', 'username', 'text', 'timestamp', 'color')
+
+        chunk = list(messages.values_list(*fields)[:chunk_size])
+        while chunk:
+            yield chunk
+            last_id, roomname, _, _, timestamp, _ = chunk[-1]
+            after = Q(roomname__gt=roomname) | \
+                Q(roomname=roomname, timestamp__gt=timestamp) | \
+                Q(roomname=roomname, timestamp=timestamp, id__gt=last_id)
+            chunk = list(messages.filter(after).values_list(*fields)
+                         [:chunk_size])
+
+    @staticmethod
+    def get_chunk_conversations(chunk: List[MessageRow],
+                                parsed: List[Tuple[str, str, str]]) \
+            -> Iterator[Tuple[MessageRow, List[str]]]:
+        for message, (text, value, style) in zip(chunk, parsed):
+            if message[5] is not None:
+                style = Color.from_index(message[5]).style
+            date = datetime.fromtimestamp(message[4] / 1000)
             date_str = date.strftime("%Y-%m-%d %H:%M:%S")
-            text, value, style = self.get_text_data_style(message.text)
-            conversations.append(
-                [date_str, message.username, style, value, text])
-        return conversations
+            yield message, [date_str, message[2], style, value, text]
 
     @staticmethod
     def get_text_data_style(text: str) -> Tuple[str, str, str]:
-        try:
-            root = etree.fromstring(text)
-            text = next(root.itertext())
-            style = root.attrib.get('style', '')
-            if root.find('data') is not None:
-                value = ' '.join(root.find('data').values())
-            else:
-                value = ''
-        except etree.XMLSyntaxError as _:
-            text = text
+        # Fast path : plain text, nothing to parse
+        if '<' not in text:
             style = ''
             value = ''
+        else:
+            try:
+                root = etree.fromstring(text)
+                text = next(root.itertext())
+                style = root.attrib.get('style', '')
+                if root.find('data') is not None:
+                    value = ' '.join(root.find('data').values())
+                else:
+                    value = ''
+            except etree.XMLSyntaxError as _:
+                text = text
+                style = ''
+                value = ''
 
         text = text.strip()
         if text.endswith('\n'):
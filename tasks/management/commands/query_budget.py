@@ -0,0 +1,431 @@
+from contextlib import ExitStack, contextmanager
+import json
+import math
+import os
+from pathlib import Path
+import sys
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.backends.base.base import BaseDatabaseWrapper
+from django.db.backends.signals import connection_created
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from core.memory import tracked
+from core.models import JsonKey
+from core.users import clear as clear_users, memoized
+
+# Maximum number of (DB queries, external calls) per scenario
+# External calls are HTTP requests to Rasa and calls to OneSignal
+# Budgets that grow with the fixture are functions of its size
+BUDGETS = {
+    # The message, the reply and its notification task, the messages, the
+    # user and its config, and the SELECT, BEGIN and INSERT that store the
+    # new button set of the reply (known sets come from the process cache)
+    'api sync_messages text': (10, 1),
+    'api sync_messages poll': (2, 0),
+    'api sync_messages_async text': (10, 1),
+    'api config': (0, 1),
+    'api ping': (0, 0),
+    # The message and the notification task
+    'api ingress': (2, 0),
+    # In one transaction : BEGIN, the SAVEPOINT, INSERT and RELEASE of the
+    # key, the message and the notification task
+    'api ingress key': (6, 0),
+    # Known to this process
+    'api ingress key retry': (0, 0),
+    # Known to another process : BEGIN, SAVEPOINT, the failing INSERT,
+    # ROLLBACK TO and RELEASE
+    'api ingress key retry elsewhere': (5, 0),
+    # BEGIN and INSERT, then a notification task per room
+    'api ingress_batch': (4, 0),
+    'api ingress_task': (2, 0),
+    'api ingress_task cancel': (2, 0),
+    'api get_names': (1, 0),
+    'demo sync_messages welcome': (12, 2),
+    'task schedule_conversation': (3, 0),
+    'task start_conversation': (4, 2),
+    'task send_notification': (1, 1),
+    'task retrieve_onesignal_ids': (3, 1),
+    # Starting the snapshot, the highest id of both tables, then the
+    # messages of both
+    'command export_conversations': (7, 0),
+    'command set_names': (1, lambda size: size['users']),
+    'command message_user': (3, 0),
+    'command start_conversation': (2, 0),
+    'command task_runner ensure_conversations': (3, 0),
+    'startup Config.setup': (1, 0),
+    # Per batch BEGIN, SELECT and the UPDATE batches, then per table and
+    # conversion the BEGIN and SELECT that find nothing is left, and the
+    # SELECT, SAVEPOINT, INSERT and RELEASE per new button set
+    'command compact_messages':
+        (lambda size: size['batches'] * (2 + size['updates']) + 8
+         + 4 * size['sets'], 0),
+    # Per chunk BEGIN, SELECT, the INSERT batches and DELETE, then the
+    # BEGIN and SELECT that find nothing is left
+    'task archive_messages':
+        (lambda size: size['chunks'] * (3 + size['inserts']) + 2, 0),
+}
+
+SECRET = 'query-budget'
+RASA_REPLY = [
+    {'text': 'Hi there', 'buttons': [{'title': 'Yes', 'payload': '/affirm'},
+                                     {'title': 'No', 'payload': '/deny'}]},
+    {'text': 'How are you?'},
+]
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.text = json.dumps(data)
+
+
+class FakeAsyncClient:
+    def __init__(self, post: Callable):
+        self._post = post
+
+    async def __aenter__(self) -> 'FakeAsyncClient':
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def post(self, url: str, *args, **kwargs) -> FakeResponse:
+        return self._post(url, *args, **kwargs)
+
+
+class Command(BaseCommand):
+    help = 'Check the DB queries and external calls of the endpoints, ' \
+           'commands and tasks against a fixed budget, on SQLite'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.external_calls = 0
+        self.queries = 0
+
+    def add_arguments(self, parser):
+        parser.add_argument('-u', '--users', type=int, default=100,
+                            help="Number of users in the fixture")
+        parser.add_argument('-m', '--messages', type=int, default=20,
+                            help="Number of messages per user in the fixture")
+        parser.add_argument('--memory', action='store_true',
+                            help="Also report the peak memory per scenario")
+
+    def handle(self, **options):
+        self.use_sqlite()
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           serialize=False)
+        self.create_missing_tables()
+
+        with TemporaryDirectory() as tmp_dir, self.stubs(Path(tmp_dir)):
+            self.create_fixture(options['users'], options['messages'])
+            results = [self.measure(name, scenario, options['memory'])
+                       for name, scenario in self.get_scenarios()]
+            size = self.get_size()
+
+        if not self.report(results, size):
+            sys.exit(1)
+
+    @staticmethod
+    def use_sqlite():
+        """ Run against an in-memory SQLite DB, whatever the settings say """
+        connections.close_all()
+        connections.databases[DEFAULT_DB_ALIAS] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        }
+        if hasattr(connections._connections, DEFAULT_DB_ALIAS):
+            del connections[DEFAULT_DB_ALIAS]
+
+    @staticmethod
+    def get_size() -> Dict[str, int]:
+        from chat.models import ArchivedChatMessage, ButtonSet
+
+        from tasks.management.commands.compact_messages import BATCH_SIZE
+
+        # SQLite limits the number of values per INSERT and UPDATE
+        fields = ArchivedChatMessage._meta.concrete_fields
+        insert_size = connection.ops.bulk_batch_size(
+            fields, [None] * settings.ARCHIVE_CHUNK)
+        update_size = connection.ops.bulk_batch_size(
+            ['pk', 'pk', 'text', 'color'], [None] * BATCH_SIZE)
+        colors = ArchivedChatMessage.objects.exclude(color=None).count()
+        buttons = ArchivedChatMessage.objects \
+            .exclude(button_set=None).count()
+
+        # Including those created by the scenarios, e.g. the demo user
+        return {
+            'users': User.objects.count(),
+            'chunks': math.ceil(ArchivedChatMessage.objects.count()
+                                / settings.ARCHIVE_CHUNK),
+            'inserts': math.ceil(settings.ARCHIVE_CHUNK / insert_size),
+            'batches': math.ceil(colors / BATCH_SIZE)
+            + math.ceil(buttons / BATCH_SIZE),
+            'sets': ButtonSet.objects.count(),
+            'updates': math.ceil(BATCH_SIZE / update_size),
+        }
+
+    @staticmethod
+    def create_missing_tables():
+        # Models without migrations in their app (e.g. Profile in 'auth')
+        tables = connection.introspection.table_names()
+        with connection.schema_editor() as editor:
+            for model in apps.get_models():
+                if model._meta.db_table not in tables:
+                    editor.create_model(model)
+
+    @contextmanager
+    def stubs(self, tmp_dir: Path) -> Iterator[None]:
+        """ Stub Rasa and OneSignal, keep all files in the temp dir """
+        for sub_dir in ('config', 'long', '_log/chat', 'export'):
+            os.makedirs(tmp_dir / sub_dir, exist_ok=True)
+        with open(tmp_dir / settings.TASKS_CSV, 'w') as f:
+            f.write('DATETIME (UTC);PARAMS\n')
+            for day in range(1, 29):
+                f.write(f'2099-02-{day:02} 12:00:00;request_tam\n')
+
+        client = mock.Mock()
+        client.view_devices.side_effect = self.fake_view_devices
+        client.send_notification.side_effect = self.count_call
+
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            with ExitStack() as stack:
+                # Also the connections of other threads, e.g. that of the
+                # DB work of the async views
+                stack.enter_context(connection.execute_wrapper(
+                    self.count_query))
+                connection_created.connect(self.count_queries)
+                stack.callback(connection_created.disconnect,
+                               self.count_queries)
+                stack.enter_context(override_settings(BACKEND_SECRET=SECRET))
+                stack.enter_context(mock.patch(
+                    'core.rasa.requests.post', side_effect=self.fake_post))
+                stack.enter_context(mock.patch(
+                    'core.rasa._async_client',
+                    return_value=FakeAsyncClient(self.fake_post)))
+                stack.enter_context(mock.patch(
+                    'api.notifications._get_client', return_value=client))
+                stack.enter_context(mock.patch(
+                    'core.config.Config._config_dir',
+                    return_value=tmp_dir / 'config'))
+                stack.enter_context(mock.patch(
+                    'api.ping._get_dir', return_value=tmp_dir / 'long'))
+                stack.enter_context(mock.patch(
+                    'builtins.input', return_value='y'))
+                stack.enter_context(mock.patch(
+                    'sys.argv', ['manage.py', 'query_budget', '-', '-']))
+                stack.enter_context(mock.patch('builtins.print'))
+                yield
+        finally:
+            os.chdir(cwd)
+
+    def count_call(self, *args, **kwargs):
+        self.external_calls += 1
+
+    def count_query(self, execute: Callable, sql: str, params: Any,
+                    many: bool, context: Dict[str, Any]) -> Any:
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+    def count_queries(self, sender, connection: BaseDatabaseWrapper,
+                      **kwargs):
+        if self.count_query not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self.count_query)
+
+    def fake_post(self, url: str, *args, **kwargs) -> FakeResponse:
+        self.count_call()
+        if url.endswith('/webhooks/rest/webhook'):
+            return FakeResponse(RASA_REPLY)
+        if url.endswith('/webhook'):
+            return FakeResponse({'responses': [{'custom': {'button': 'B'}}]})
+        return FakeResponse({})
+
+    def fake_view_devices(self, query: Dict[str, int]) -> FakeResponse:
+        self.count_call()
+        players = [{'id': f'os-{i}', 'external_user_id': f'sub-{i}',
+                    'last_active': i} for i in range(len(self.usernames))]
+        return FakeResponse({'players': players,
+                             'total_count': len(players)})
+
+    def create_fixture(self, users: int, messages: int):
+        from chat.models import ChatMessage
+
+        self.usernames = [f'user{i:05}@eur.nl' for i in range(users)]
+        chat_messages = []
+        for i, username in enumerate(self.usernames):
+            user = User.objects.create(username=username, first_name='First',
+                                       last_name=f'Last {i}')
+            user.profile.sub_id = f'sub-{i}'
+            user.profile.onesignal_id = f'os-{i}' if i % 2 else ''
+            user.profile.config_str = json.dumps({JsonKey.language: 'EN'})
+            user.profile.save()
+            for j in range(messages):
+                chat_messages.append(ChatMessage(
+                    roomname=username,
+                    username=settings.CHAT_MASTER if j % 2 else username,
+                    text=f"<span style='color: blue;'>Message {j}</span>",
+                    buttons_str=json.dumps(RASA_REPLY[0]['buttons']),
+                    timestamp=1600000000000 + i * messages + j))
+        ChatMessage.objects.bulk_create(chat_messages)
+
+    def get_scenarios(self) -> List[Tuple[str, Callable]]:
+        from api import views as api_views
+        from api.models import IngressKey
+        from api.notifications import retrieve_onesignal_ids, \
+            send_notification
+        from api.ping import add_web_ping
+        from chat.archive import archive_messages
+        from chat.conversation import schedule_conversation, \
+            start_conversation
+        from core.config import Config
+        from demo import views as demo_views
+        from tasks.management.commands.task_runner import \
+            Command as TaskRunner
+
+        username = self.usernames[1]
+        user = User.objects.get(username=username)
+        factory = APIRequestFactory()
+
+        def api_post(view, data):
+            request = factory.post('/', data, format='json')
+            force_authenticate(request, user)
+            return view(request)
+
+        def backend_post(view, data):
+            data['backend_secret'] = SECRET
+            request = RequestFactory().post(
+                '/', json.dumps(data), content_type='application/json')
+            return view(request)
+
+        def ping():
+            add_web_ping(username)
+            api_post(api_views.ping, {})
+
+        def demo_welcome():
+            request = factory.post('/', {JsonKey.language: 'EN'},
+                                   format='json', REMOTE_ADDR='10.0.0.1')
+            demo_views.sync_messages(request)
+
+        def retry_elsewhere():
+            IngressKey._recent.clear()
+            backend_post(api_views.ingress, dict(keyed))
+
+        def export():
+            os.chdir('export')
+            try:
+                call_command('export_conversations')
+            finally:
+                os.chdir('..')
+
+        language = {JsonKey.language: 'EN'}
+        keyed = {JsonKey.roomname: username, JsonKey.text: 'Hello once',
+                 'idempotency_key': 'rasa-1'}
+        task = {'task': '/request_tam', 'username': username,
+                'timestamp': 1900000000}
+        return [
+            ('api sync_messages text', lambda: api_post(
+                api_views.sync_messages,
+                {JsonKey.text: 'Hello', JsonKey.fromstamp: 1900000000000,
+                 **language})),
+            ('api sync_messages poll', lambda: api_post(
+                api_views.sync_messages, {JsonKey.fromstamp: 0, **language})),
+            # Run as under ASGI, the DB work in this thread
+            ('api sync_messages_async text', lambda: api_post(
+                async_to_sync(api_views.sync_messages_async),
+                {JsonKey.text: 'Hello', JsonKey.fromstamp: 1900000000000,
+                 **language})),
+            ('api config', lambda: api_post(api_views.config, language)),
+            ('api ping', ping),
+            ('api ingress', lambda: backend_post(
+                api_views.ingress, {JsonKey.roomname: username,
+                                    JsonKey.text: 'Hello from Rasa'})),
+            ('api ingress key', lambda: backend_post(
+                api_views.ingress, dict(keyed))),
+            ('api ingress key retry', lambda: backend_post(
+                api_views.ingress, dict(keyed))),
+            ('api ingress key retry elsewhere', retry_elsewhere),
+            ('api ingress_batch', lambda: backend_post(
+                api_views.ingress_batch, {JsonKey.messages: [
+                    {JsonKey.roomname: roomname, JsonKey.text: text,
+                     JsonKey.buttons: RASA_REPLY[0]['buttons']}
+                    for roomname in (username, self.usernames[2])
+                    for text in ('Hello from Rasa', 'And more')]})),
+            ('api ingress_task', lambda: backend_post(
+                api_views.ingress_task, dict(task))),
+            ('api ingress_task cancel', lambda: backend_post(
+                api_views.ingress_task, dict(task, cancel=True))),
+            ('api get_names', lambda: backend_post(
+                api_views.get_names, {JsonKey.username: username})),
+            ('demo sync_messages welcome', demo_welcome),
+            ('task schedule_conversation',
+             lambda: schedule_conversation.now('/request_tam')),
+            ('task start_conversation',
+             lambda: start_conversation.now('/request_tam', username)),
+            ('task send_notification',
+             lambda: send_notification.now(username)),
+            ('task retrieve_onesignal_ids',
+             lambda: retrieve_onesignal_ids.now()),
+            ('command export_conversations', export),
+            ('command set_names', lambda: call_command('set_names')),
+            ('command message_user', lambda: call_command(
+                'message_user', message=['Hi'], username=[username])),
+            ('command start_conversation', lambda: call_command(
+                'start_conversation', conversation='request_tam',
+                username=[username])),
+            ('command task_runner ensure_conversations',
+             TaskRunner.ensure_conversations),
+            ('startup Config.setup', Config.setup),
+            # Last, these change all messages of the fixture
+            ('command compact_messages',
+             lambda: call_command('compact_messages')),
+            ('task archive_messages', lambda: archive_messages.now()),
+        ]
+
+    def measure(self, name: str, scenario: Callable, memory: bool) \
+            -> Tuple[str, int, int, Optional[int]]:
+        self.external_calls = 0
+        self.queries = 0
+        # Each as a request or task of its own, with a cold process cache
+        clear_users()
+        with ExitStack() as stack:
+            # Tasks don't use the process cache, as in run_task
+            stack.enter_context(
+                memoized(process_cache=not name.startswith('task ')))
+            measurement = stack.enter_context(tracked(name)) \
+                if memory else None
+            scenario()
+        return name, self.queries, self.external_calls, \
+            measurement.peak if measurement else None
+
+    @staticmethod
+    def report(results: List[Tuple[str, int, int, Optional[int]]],
+               size: Dict[str, int]) -> bool:
+        """ Print the results, return False if any is over budget """
+        success = True
+        lines = [f"{'SCENARIO':<42} {'QUERIES':>9} {'EXTERNAL':>10}"
+                 f"{'  PEAK KiB' if results and results[0][3] else ''}"]
+        for name, queries, external, peak in results:
+            max_queries, max_external = [
+                budget(size) if callable(budget) else budget
+                for budget in BUDGETS[name]]
+            over = queries > max_queries or external > max_external
+            success = success and not over
+            lines.append(f'{name:<42} {queries:>4}/{max_queries:<4} '
+                         f'{external:>4}/{max_external:<5}'
+                         f'{f"{peak / 1024:>10,.0f}" if peak else ""}'
+                         f'{"  OVER BUDGET" if over else ""}')
+
+        sys.stdout.write('\n' + '\n'.join(lines) + '\n\n')
+        return success
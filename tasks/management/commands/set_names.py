@@ -50,6 +50,6 @@ class Command(BaseCommand):
                 print()
                 sys.exit(1)
         else:
-            users = list(User.objects.all())
+            users = list(User.objects.select_related('profile'))
 
         return users
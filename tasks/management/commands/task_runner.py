@@ -1,7 +1,8 @@
 import csv
 from datetime import datetime
-import os
+import logging
 from pathlib import Path
+import sys
 import time
 from typing import List
 
@@ -10,49 +11,89 @@ from background_task.tasks import tasks, autodiscover
 from dateutil import parser
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import DatabaseError
 from pytz import timezone
 
-from chat.conversation import schedule_conversation
+from chat.conversation import BULK_SIZE, schedule_conversation
+from chat.pacing import Pacer
+from core.utils import date_string
+from tasks.scheduler import TaskScheduler, THREAD, PROCESS, read_status
+
+logger_app = logging.getLogger('app')
 
 
 class Command(BaseCommand):
     help = 'Run tasks periodically'
 
     def handle(self, **options):
+        if options['status']:
+            sys.exit(0 if self.print_status() else 1)
+
         self.ensure_conversations()
         self.ensure_one_signal()
-        self.task_runner()
+        self.ensure_archive()
+        self.ensure_ingress_keys()
+        self.task_runner(options['workers'], options['pool'])
+
+    def add_arguments(self, parser):
+        parser.add_argument('-w', '--workers', type=int,
+                            default=settings.TASKS_WORKERS,
+                            help="Number of tasks to run concurrently")
+        parser.add_argument('-p', '--pool', choices=[THREAD, PROCESS],
+                            default=settings.TASKS_POOL,
+                            help="Run the tasks in threads or processes")
+        parser.add_argument('-s', '--status', action='store_true',
+                            help="Show if the running task runner is alive")
 
     @classmethod
-    def task_runner(cls):
+    def task_runner(cls, workers: int, pool: str):
         autodiscover()
 
-        while True:
-            more_tasks = tasks.run_next_task()
-            if more_tasks:
-                time.sleep(.1)
-            else:
-                time.sleep(1)
-
-            cls.crash_on_db_loss()
+        scheduler = TaskScheduler(tasks, settings.TASKS_REFRESH,
+                                  workers, pool, Pacer())
+        scheduler.open()
+        scheduler.reload()
+        try:
+            while True:
+                try:
+                    scheduler.dispatch()
+                    scheduler.heartbeat()
+                    # Also the tasks stored while dispatching, before the
+                    # timeout is computed
+                    scheduler.poll()
+                    scheduler.wait()
+                except DatabaseError as e:
+                    logger_app.warning(e, extra={'origin': 'TASK RUNNER'})
+                    scheduler.recover()
+        finally:
+            scheduler.close()
 
     @staticmethod
-    def crash_on_db_loss():
-        # Unfortunately, background tasks can't reconnect if DB conn is lost
-        # Look for error in log, crash the process, let cron restart
-        with open('./_log/tasks.log', 'rb') as f:
-            f.seek(-2, os.SEEK_END)
-            while f.read(1) != b'\n':
-                f.seek(-2, os.SEEK_CUR)
-            last_line = f.readline().decode().replace('\n', '')
-
-            if last_line == 'Failed to retrieve tasks. Database unreachable.':
-                print()
-                print('Exiting...')
-                print()
-
-                import sys
-                sys.exit(1)
+    def print_status() -> bool:
+        """ Print the liveness info of the running task runner
+
+            :return: True if the runner is alive and connected to the DB
+        """
+        status = read_status()
+        if not status:
+            print()
+            print('The task runner never ran')
+            print()
+            return False
+
+        def as_date(stamp):
+            return date_string(datetime.fromtimestamp(stamp)) if stamp else '-'
+
+        # The runner writes at least once per refresh, even when idle
+        alive = time.time() - status['alive_at'] < 2 * settings.TASKS_REFRESH
+        print()
+        print(f"PID             : {status['pid']}")
+        print(f"Alive at        : {as_date(status['alive_at'])}")
+        print(f"Last dispatch   : {as_date(status['last_dispatch_at'])}")
+        print(f"Database        : {'up' if status['db_alive'] else 'down'}")
+        print(f"Status          : {'alive' if alive else 'dead'}")
+        print()
+        return alive and status['db_alive']
 
     @staticmethod
     def ensure_one_signal():
@@ -60,18 +101,27 @@ class Command(BaseCommand):
         retrieve_onesignal_ids(repeat=settings.REPEAT,
                                remove_existing_tasks=True)
 
+    @staticmethod
+    def ensure_archive():
+        from chat.archive import archive_messages
+        archive_messages(repeat=settings.ARCHIVE_REPEAT,
+                         remove_existing_tasks=True)
+
+    @staticmethod
+    def ensure_ingress_keys():
+        from api.ingress import evict_ingress_keys
+        evict_ingress_keys(repeat=settings.INGRESS_KEY_REPEAT,
+                           remove_existing_tasks=True)
+
     @classmethod
     def ensure_conversations(cls):
-        # Get the already scheduled tasks
-        all_tasks = Task.objects.all()
-        task_tuples = {(task.params()[0][0] if task.params()[0] else '',
-                        task.run_at) for task in all_tasks}
-
         # Get all the needed tasks
         file_path = Path(settings.TASKS_CSV)
         needed_tasks = cls.read_csv(file_path)
         now = datetime.now().replace(tzinfo=timezone('UTC'))
 
+        task_manager = TaskManager()
+        new_tasks = {}
         for needed_task in needed_tasks:
             conversation_name = needed_task[1].strip()
             # Make sure the conversations are triggered via direct intent
@@ -84,15 +134,25 @@ class Command(BaseCommand):
             if date_time < now:
                 continue
 
-            # Don't try to reschedule same task
-            if (conversation_name, date_time) in task_tuples:
-                continue
-
-            task = TaskManager().new_task(schedule_conversation.name,
-                                          args=(conversation_name,),
-                                          run_at=date_time,
-                                          remove_existing_tasks=False)
-            task.save()
+            task = task_manager.new_task(schedule_conversation.name,
+                                         args=(conversation_name,),
+                                         run_at=date_time,
+                                         remove_existing_tasks=False)
+            new_tasks[(task.task_hash, date_time)] = task
+        if not new_tasks:
+            return
+
+        # Don't try to reschedule same task : the (indexed) task hash covers
+        # the task name and conversation, only look within the CSV window
+        run_ats = [run_at for _, run_at in new_tasks.keys()]
+        scheduled = Task.objects \
+            .filter(task_hash__in={task_hash for task_hash, _ in new_tasks},
+                    run_at__range=(min(run_ats), max(run_ats))) \
+            .values_list('task_hash', 'run_at')
+        for key in scheduled:
+            new_tasks.pop(key, None)
+
+        Task.objects.bulk_create(new_tasks.values(), batch_size=BULK_SIZE)
 
     @staticmethod
     def read_csv(file_path: Path) -> List:
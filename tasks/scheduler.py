@@ -0,0 +1,463 @@
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+import heapq
+import inspect
+import json
+import logging
+from multiprocessing import get_context
+import os
+from pathlib import Path
+import select
+import time
+from typing import Any, Deque, Dict, List, Optional, TYPE_CHECKING, Tuple
+
+from background_task.models import Task
+from background_task.tasks import Tasks, tasks
+from django.db import DatabaseError, close_old_connections, connection, \
+    connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from core.profiling import is_sampled, profiled
+from core.users import memoized
+
+if TYPE_CHECKING:
+    from chat.pacing import Pacer
+
+logger_app = logging.getLogger('app')
+
+THREAD = 'thread'
+PROCESS = 'process'
+
+
+def _get_fifo() -> Path:
+    base_dir = Path(os.path.dirname(__file__)).parents[0]
+    return base_dir / '_data' / 'tasks' / 'wakeup'
+
+
+def _get_status_file() -> Path:
+    return _get_fifo().parent / 'status.json'
+
+
+def read_status() -> Dict[str, Any]:
+    """ Get the liveness info the task runner last wrote
+
+        :return: dict with pid, alive_at, last_dispatch_at (timestamps)
+            and db_alive, or an empty dict if the runner never ran
+    """
+    try:
+        with open(_get_status_file(), 'r') as f:
+            return json.loads(f.read() or '{}')
+    except FileNotFoundError as _:
+        return {}
+
+
+def db_is_alive() -> bool:
+    """ Check the DB connection of this thread with a trivial query
+        A broken connection is closed, the next query will reconnect
+    """
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        return True
+    except DatabaseError as _:
+        try:
+            connection.close()
+        except DatabaseError as _:
+            pass
+        return False
+
+
+def wake_up():
+    """ Tell a waiting task runner that a new task was stored
+        Doesn't block and is a no-op if no runner is listening
+    """
+    try:
+        fd = os.open(str(_get_fifo()), os.O_WRONLY | os.O_NONBLOCK)
+    except OSError as _:
+        # No FIFO (runner never started) or no reader (runner not running)
+        return
+    try:
+        os.write(fd, b'.')
+    except BlockingIOError as _:
+        # The pipe is full, so the runner has plenty of wake-ups pending
+        pass
+    finally:
+        os.close(fd)
+
+
+def task_saved(sender, instance: Task, created: bool, **kwargs):
+    """ Signal receiver for Task, wakes up the runner for new tasks
+        Once committed, before that the runner wouldn't see the task
+    """
+    if created:
+        transaction.on_commit(wake_up)
+
+
+def get_arguments(tasks: Tasks, task: Task) -> Dict[str, Any]:
+    """ The arguments of the task by parameter name, empty if they don't
+        match the signature of the task function
+    """
+    args, kwargs = task.params()
+    function = tasks._tasks[task.task_name].task_function
+    try:
+        return inspect.signature(function).bind(*args, **kwargs).arguments
+    except TypeError as _:
+        return {}
+
+
+def run_task(task_id: int):
+    """ Run a task claimed by the scheduler, in a worker thread or process
+
+        :param task_id: the id of the locked task
+    """
+    # Don't keep using a connection that broke during an earlier task
+    close_old_connections()
+    task = Task.objects.filter(id=task_id).first()
+    if not task:
+        return
+
+    # Fresh from the DB, the process cache might miss a change made by the
+    # web workers
+    with memoized(process_cache=False):
+        if is_sampled():
+            username = get_arguments(tasks, task).get('username')
+            with profiled(task.task_name, username):
+                tasks.run_task(task)
+        else:
+            tasks.run_task(task)
+
+
+def _init_process():
+    # Don't share the DB connections of the runner with the forked worker
+    for connection in connections.all():
+        connection.connection = None
+
+
+class WorkerPool:
+    """ Run tasks concurrently in a pool of threads or processes
+        Tasks with the same key (the username if the task has one) run in
+        the order they were submitted, one at a time
+    """
+
+    def __init__(self, tasks: Tasks, workers: int = 1, pool: str = THREAD,
+                 notify=None):
+        """
+            :param tasks: the registry of the background tasks
+            :param workers: the number of threads or processes
+            :param pool: either THREAD or PROCESS
+            :param notify: called (in a worker thread) when a task finished
+        """
+        self.tasks = tasks
+        self.workers = workers
+        if pool == PROCESS:
+            self._executor = ProcessPoolExecutor(
+                workers, mp_context=get_context('fork'),
+                initializer=_init_process)
+        else:
+            self._executor = ThreadPoolExecutor(workers)
+        self._notify = notify
+        self._queues: Dict[str, Deque[int]] = {}
+        self._running: Dict[Future, str] = {}
+        self._claimed = 0
+
+    def claimed(self, task_id: int) -> bool:
+        """ Whether the task was submitted and didn't finish yet """
+        return any(task_id in queue for queue in self._queues.values())
+
+    @property
+    def full(self) -> bool:
+        # Don't claim more than can be run soon, leave those to other runners
+        return self._claimed >= 2 * self.workers
+
+    def key(self, task: Task) -> str:
+        return get_arguments(self.tasks, task).get('username') \
+            or task.task_name
+
+    def submit(self, task: Task):
+        """ Run the task as soon as the previous task with its key finished """
+        key = self.key(task)
+        queue = self._queues.setdefault(key, deque())
+        queue.append(task.id)
+        self._claimed += 1
+        if len(queue) == 1:
+            self._start(key)
+
+    def _start(self, key: str):
+        future = self._executor.submit(run_task, self._queues[key][0])
+        self._running[future] = key
+        if self._notify:
+            future.add_done_callback(lambda _: self._notify())
+
+    def reap(self) -> List[int]:
+        """ Start the next task for the keys of the finished tasks
+
+            :return: the ids of the finished tasks
+        """
+        finished = []
+        for future in [f for f in self._running if f.done()]:
+            key = self._running.pop(future)
+            queue = self._queues[key]
+            finished.append(queue.popleft())
+            self._claimed -= 1
+            if future.exception():
+                logger_app.warning(future.exception(),
+                                   extra={'origin': 'TASK RUNNER'})
+            if queue:
+                self._start(key)
+            else:
+                del self._queues[key]
+        return finished
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class TaskScheduler:
+    """ Run background tasks at their run_at, without polling the DB
+
+        The (run_at, id) of the upcoming tasks are kept in a heap. The
+        scheduler sleeps until the first one is due, or until a new task is
+        announced via the wake-up FIFO. New tasks are loaded incrementally
+        (id > last seen id), everything up to the horizon is reloaded
+        every `refresh` seconds to pick up changes made by others.
+        With a pacer, due tasks for a busy Rasa bot are put aside until a
+        task for that bot finished.
+    """
+
+    def __init__(self, tasks: Tasks, refresh: float = 60,
+                 workers: int = 1, pool: str = THREAD,
+                 pacer: 'Pacer' = None):
+        self.tasks = tasks
+        self.refresh = refresh
+        self.pool = WorkerPool(tasks, workers, pool, self._poke)
+        self.pacer = pacer
+        self.worker_name = str(os.getpid())
+        self._heap: List[Tuple[datetime, int]] = []
+        # {port: (run_at, id)} of the due tasks waiting for their Rasa bot
+        self._waiting: Dict[int, Deque[Tuple[datetime, int]]] = {}
+        # The later tasks of a user with a waiting task, to keep their order
+        # {key: (id of the waiting task, [(run_at, id)])}, and {id: key}
+        self._held: Dict[str, Tuple[int, List[Tuple[datetime, int]]]] = {}
+        self._holding: Dict[int, str] = {}
+        self._last_id = 0
+        self._horizon = timezone.now()
+        self._fifo = None
+        self._status = {'pid': os.getpid(), 'alive_at': 0,
+                        'last_dispatch_at': None, 'db_alive': True}
+
+    def open(self):
+        """ Create and open the wake-up FIFO
+            Opened read-write so select doesn't spin when all writers are gone
+        """
+        fifo = _get_fifo()
+        os.makedirs(str(fifo.parent), exist_ok=True)
+        if not fifo.exists():
+            os.mkfifo(str(fifo))
+        self._fifo = os.open(str(fifo), os.O_RDWR | os.O_NONBLOCK)
+
+    def close(self):
+        self.pool.shutdown()
+        if self._fifo is not None:
+            os.close(self._fifo)
+            self._fifo = None
+
+    def _poke(self):
+        """ Wake up the scheduler from within this process """
+        try:
+            os.write(self._fifo, b'.')
+        except BlockingIOError as _:
+            pass
+
+    def _pending(self):
+        """ The tasks that are not failed and known to this process """
+        return Task.objects.filter(task_name__in=self.tasks._tasks.keys(),
+                                   failed_at=None)
+
+    def _load(self, queryset):
+        for task_id, run_at in queryset.values_list('id', 'run_at'):
+            # Tasks beyond the horizon are picked up by the next reload
+            if run_at < self._horizon:
+                heapq.heappush(self._heap, (run_at, task_id))
+            self._last_id = max(self._last_id, task_id)
+
+    def reload(self):
+        """ Rebuild the heap with all tasks before the new horizon """
+        self._horizon = timezone.now() + timedelta(seconds=self.refresh)
+        self._heap = []
+        # They are loaded again
+        self._waiting = {}
+        self._held = {}
+        self._holding = {}
+        if self.pacer is not None:
+            # Only the claimed tasks can hold a slot
+            leaked = self.pacer.retain(self.pool.claimed)
+            if leaked:
+                logger_app.warning(f"Freed {leaked} pacer slots of tasks "
+                                   f"that weren't running",
+                                   extra={'origin': 'TASK RUNNER'})
+        # Tasks stored in between are loaded twice, which is harmless
+        last_id = Task.objects.aggregate(last_id=Max('id'))['last_id']
+        self._last_id = max(self._last_id, last_id or 0)
+        self._load(self._pending().filter(run_at__lt=self._horizon))
+
+    def poll(self):
+        """ Load the tasks stored since the last (re)load """
+        if timezone.now() >= self._horizon:
+            self.reload()
+            return
+
+        self._load(self._pending().filter(id__gt=self._last_id))
+
+    def requeue(self, task_id: int):
+        """ Put a task back on the heap if it's still pending, e.g. after
+            it was rescheduled because it failed
+        """
+        run_at = self._pending().filter(id=task_id) \
+            .values_list('run_at', flat=True).first()
+        if run_at is not None and run_at < self._horizon:
+            heapq.heappush(self._heap, (run_at, task_id))
+
+    def next_due(self) -> Optional[Task]:
+        """ Get and lock the first task that is due, if any """
+        now = timezone.now()
+        while self._heap and self._heap[0][0] <= now:
+            _, task_id = heapq.heappop(self._heap)
+            # Still running, loaded again by a reload
+            if self.pool.claimed(task_id):
+                continue
+            task = self._pending().filter(id=task_id).first()
+            # Already run or deleted
+            if task is None:
+                self._unhold(task_id)
+                continue
+            # Rescheduled in the meantime
+            if task.run_at > now:
+                self._unhold(task_id)
+                if task.run_at < self._horizon:
+                    heapq.heappush(self._heap, (task.run_at, task_id))
+                continue
+            # Behind an earlier task of the user that waits for its Rasa bot
+            key = self.pool.key(task)
+            if key in self._held and self._held[key][0] != task_id:
+                self._held[key][1].append((task.run_at, task_id))
+                continue
+            # Wait until a task for the same Rasa bot finished
+            if not self._acquire(task, key):
+                continue
+            self._unhold(task_id)
+            # Fails if locked by another runner
+            locked_task = task.lock(self.worker_name)
+            if locked_task:
+                return locked_task
+            self._release(task_id)
+        return None
+
+    def _acquire(self, task: Task, key: str) -> bool:
+        """ Take a slot of the pacer, or put the task aside until one is
+            released. The later tasks of the user are held until then
+
+            :param key: the key of the task in the pool
+            :return: True if the task can run now
+        """
+        if self.pacer is None:
+            return True
+        port = self.pacer.get_port(task.task_name,
+                                   get_arguments(self.tasks, task))
+        if port is None or self.pacer.acquire(task.id, port):
+            return True
+        self._waiting.setdefault(port, deque()) \
+            .append((task.run_at, task.id))
+        if key not in self._held:
+            self._held[key] = (task.id, [])
+            self._holding[task.id] = key
+        return False
+
+    def _unhold(self, task_id: int):
+        """ Put the tasks held behind the task back on the heap """
+        key = self._holding.pop(task_id, None)
+        if key is None:
+            return
+        _, held = self._held.pop(key)
+        for run_at_id in held:
+            heapq.heappush(self._heap, run_at_id)
+
+    def _release(self, task_id: int):
+        """ Free the slot of the task, the first task waiting for it gets
+            another try
+        """
+        if self.pacer is None:
+            return
+        waiting = self._waiting.get(self.pacer.release(task_id))
+        if waiting:
+            heapq.heappush(self._heap, waiting.popleft())
+
+    def timeout(self) -> float:
+        """ Seconds until the first task is due or the horizon is reached
+            With all workers busy, only a finished task can wake it earlier
+        """
+        wake_at = self._horizon
+        if self._heap and not self.pool.full:
+            wake_at = min(wake_at, self._heap[0][0])
+        return max((wake_at - timezone.now()).total_seconds(), 0)
+
+    def wait(self, timeout: float = None):
+        """ Sleep until the timeout or a wake-up, whichever comes first """
+        if timeout is None:
+            timeout = self.timeout()
+        readable, _, _ = select.select([self._fifo], [], [], timeout)
+        if readable:
+            # Drain, multiple wake-ups are handled by a single poll
+            try:
+                while os.read(self._fifo, 512):
+                    pass
+            except BlockingIOError as _:
+                pass
+
+    def heartbeat(self, force: bool = False):
+        """ Write the liveness info, at most once a second unless forced """
+        now = time.time()
+        if not force and now - self._status['alive_at'] < 1:
+            return
+        self._status['alive_at'] = now
+        with open(_get_status_file(), 'w') as f:
+            json.dump(self._status, f)
+
+    def recover(self, max_backoff: float = 60):
+        """ Wait for the DB to come back, with exponential backoff,
+            then reload since tasks might have changed in the meantime
+        """
+        self._status['db_alive'] = False
+        backoff = 1
+        while not db_is_alive():
+            logger_app.warning(f"Database unreachable, retry in {backoff}s",
+                               extra={'origin': 'TASK RUNNER'})
+            self.heartbeat(force=True)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff)
+
+        self._status['db_alive'] = True
+        self.heartbeat(force=True)
+        self.reload()
+
+    def dispatch(self) -> int:
+        """ Hand the due tasks to the workers, as long as there is room
+
+            :return: the number of tasks that were claimed
+        """
+        for task_id in self.pool.reap():
+            self._release(task_id)
+            self.requeue(task_id)
+
+        count = 0
+        while not self.pool.full:
+            task = self.next_due()
+            if task is None:
+                break
+            self.pool.submit(task)
+            count += 1
+
+        if count:
+            self._status['last_dispatch_at'] = time.time()
+        return count